@@ -2,14 +2,18 @@ import os, sys, json, random
 from copy import deepcopy
 import argparse
 from tqdm import tqdm
-import gc
+from multiprocessing import Pool
+import time
+import tracemalloc
 
 sys.path.append(os.path.dirname(__file__))
 
-from database_utils import Column, Table, Value, Database
-from sql_parser import SQLEncoder
-from sql_unparser import SQLDecoder, Unparser
+from database_utils import Column, Table, Value, Database, DatabaseRegistry, database_hash, with_agents
+from sql_parser import SQLEncoder, EncodeCache
+from sql_unparser import SQLDecoder, Unparser, Emitter
 from entity_relation_graph import ERG, update_schema_linking
+from jsonl_utils import JsonlWriter, iter_jsonl, jsonl_counterpart, load_records, load_tables
+from cell_utils import CellValueStore
 from qualifier import *
 from eval.spider.process_sql import get_sql
 
@@ -78,17 +82,126 @@ def get_schema(db):
     return schema
 
 
+class Checkpoint:
+    """
+    Progress of a --gen_all run: index of the next example, the counters of the generator,
+    the emitted db_ids and the size of both outputs, saved every `interval` examples
+    """
+
+    def __init__(self, path, interval=100):
+        self.path = path
+        self.interval = interval
+        self.state = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            self.state = json.load(open(self.path, 'r'))
+        return self.state
+
+    def open(self, data_path, table_path):
+        if self.state is None:
+            return JsonlWriter(data_path), JsonlWriter(table_path)
+        data_offset, table_offset = self.state["offsets"]
+        data_count, table_count = self.state["counts"]
+        return JsonlWriter.resume(data_path, data_offset, data_count), \
+            JsonlWriter.resume(table_path, table_offset, table_count)
+
+    def restore(self, generator):
+        """
+        :return: index of the next example and the emitted db_ids
+        """
+        if self.state is None:
+            return 0, set()
+        generator.statistic = dict(self.state["statistic"])
+        generator.seed = dict(self.state["seed"])
+        if generator.dedup is not None:
+            generator.dedup = DatabaseDeduplicator(self.state["dedup"])
+        return self.state["index"], set(self.state["db_ids"])
+
+    def save(self, index, generator, aug_db_ids, data_writer, table_writer):
+        data_writer.flush()
+        table_writer.flush()
+        self.state = {
+            "index": index,
+            "statistic": generator.statistic,
+            "seed": generator.seed,
+            "db_ids": sorted(aug_db_ids),
+            "offsets": [data_writer.tell(), table_writer.tell()],
+            "counts": [len(data_writer), len(table_writer)],
+            "dedup": None if generator.dedup is None else generator.dedup.state()
+        }
+        # write then rename, an interruption never leaves a half written checkpoint
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DatabaseDeduplicator:
+    """
+    Map generated databases with identical contents (see database_hash) to the db_id emitted first,
+    only databases generated from the same source database are merged
+    """
+
+    def __init__(self, state=None):
+        state = {} if state is None else state
+        self.hashes = state.get("hashes", {})  # source db_id + content hash: shared db_id
+        self.aliases = state.get("aliases", {})  # db_id: shared db_id
+        self.merged = state.get("merged", 0)
+        self.saved_bytes = state.get("saved_bytes", 0)
+
+    def resolve(self, new_data, new_db):
+        db_id = new_data["db_id"]
+        if db_id not in self.aliases:
+            source = db_id[:-len(new_data["gen_log"]) - 1]
+            key = source + ':' + database_hash(new_db)
+            if key in self.hashes:
+                self.merged += 1
+                self.saved_bytes += len(json.dumps(new_db, indent=4))
+            else:
+                self.hashes[key] = db_id
+            self.aliases[db_id] = self.hashes[key]
+        return self.aliases[db_id]
+
+    def state(self):
+        return {"hashes": self.hashes, "aliases": self.aliases, "merged": self.merged, "saved_bytes": self.saved_bytes}
+
+    def report(self):
+        return f"Deduplicate {self.merged} databases of {len(self.aliases)}, " \
+               f"saving {self.saved_bytes / 1024 / 1024:.2f} MB of table output"
+
+
 class Generator:
 
     BANQES = ["What are the lot details of lots associated with transactions with share count smaller than 50?",
               'What are the lot details of lots associated with transactions whose share count is bigger than 100 and whose type code is "PUR"?']
 
-    def __init__(self, n_step=1, affected=True, keep_original=False):
+    def __init__(self, n_step=1, affected=True, keep_original=False, sql_mode="reparse", cell_store=None):
         self.n_step = n_step
         self.affected = affected
         self.keep_original = keep_original
         self.statistic = {"e2a": 0, "c2a": 0, "r2u": 0, "u2r": 0}
         self.seed = {"e2a": 0, "c2a": 0, "r2u": 0, "u2r": 0, "total": 0}
+        self.dedup = None
+        self.encode_cache = EncodeCache()
+        self.databases = None  # DatabaseRegistry of the tables generated from, see get_database
+        # reparse: get_sql on the face code, emit: Emitter on the decoded tree, verify: both and compare
+        self.sql_mode = sql_mode
+        self.sql_check = {"match": 0, "mismatch": 0, "error": 0}
+        self.sql_failures = []  # query, db_id and both sql dicts (or the error) of every mismatch and error
+        # CellValueStore of the source databases, generated databases then refer to its columns
+        self.cell_store = cell_store
+
+    def compact(self, new_db, db_id):
+        if self.cell_store is None:
+            return new_db
+        return self.cell_store.compact(new_db, db_id)
 
     def generate_one_step(self, erg: ERG, steps):
         methods = ["e2a", "c2a", "r2u", "u2r"]
@@ -132,8 +245,7 @@ class Generator:
             new_query = unparser.get_face_code()
 
             new_db = acdb.to_dict()
-            schema = Schema(new_db)
-            sql = get_sql(schema, new_query)
+            sql = self.get_new_sql(ast, new_db, new_query)
             encoder = SQLEncoder(Database(new_db))
 
             new_data = {
@@ -153,18 +265,19 @@ class Generator:
         aug_dataset = []
         aug_dbs = {db_id: {} for db_id in dbs}
         aug_databases = []
+        sources = {}  # db_id -> table dict with its agents, see with_agents
         for data in dataset:
             # if data["question"] != 'Find the name of product that is produced by both companies Creative Labs and Sony.':
             #     continue
             db_id = data["db_id"]
-            if db_id == "baseball_1":
-                continue
-            db = Database(dbs[db_id])
+            if db_id not in sources:
+                sources[db_id] = with_agents(dbs[db_id])
+            db = Database(sources[db_id])
             res = self.generate_single(db, data)
             if res is None:
                 if self.keep_original:
                     aug_dataset.append(data)
-                    aug_databases.append(db.to_dict())
+                    aug_databases.append(self.compact(db.to_dict(), db_id))
             else:
                 new_data, new_db, steps = res
                 steps = '|'.join(steps)
@@ -172,9 +285,8 @@ class Generator:
                     new_data["db_id"] = db_id + '_' + str(list(aug_dbs[db_id].keys()).index(steps))
                 else:
                     new_data["db_id"] = db_id + '_' + str(len(aug_dbs[db_id]))
-                    aug_dbs[db_id][steps] = new_db
+                    aug_dbs[db_id][steps] = self.compact(new_db, db_id)
                 aug_dataset.append(new_data)
-            gc.collect()
 
         for db_id in aug_dbs:
             for i, db in enumerate(aug_dbs[db_id]):
@@ -182,83 +294,185 @@ class Generator:
                 aug_databases.append(aug_dbs[db_id][db])
         return aug_dataset, aug_databases
 
-    def generate_all(self, dbs, dataset):
+    def generate_all_single(self, db: Database, data):
+        """
+        Apply every candidate transformation to one example
+        :return: list of (method, new_data, new_db)
+        """
         filters = {"e2a": filter_for_e2a,
                    "c2a": filter_for_c2a,
                    "r2u": filter_for_r2u,
                    "u2r": filter_for_u2r}
-        aug_dataset = []
-        aug_db_ids = []
-        aug_databases = []
-        for data in dataset:
-            db_id = data["db_id"]
-            if db_id == "baseball_1":
-                continue
-            db = Database(dbs[db_id])
-            if data["question"] in self.BANQES:
-                continue
+        db_id = data["db_id"]
+        results = []
+        sql = data["sql"]
+        # the example is encoded once, every candidate is applied to the same graph and rolled back
+        acdb, values = self.encode_cache.encode(db, sql)
+        erg = ERG(acdb, values)
+        candidates = []
+        for method in ["e2a", "c2a", "r2u", "u2r"]:
+            whitelist = filters[method](erg, self.affected)
+            for elements in whitelist:
+                candidates.append([method, *elements])
+        # a single candidate can transform the graph directly
+        transaction = len(candidates) > 1
+        if transaction:
+            erg.begin()
+        for i, trans in enumerate(candidates):
+            method, *elements = trans
+            if i > 0:
+                erg.rollback()
+            if method == "e2a":
+                erg.convert_entity_to_attribute(*elements)
+            elif method == "c2a":
+                erg.convert_concept_to_attribute(*elements)
+            elif method == "r2u":
+                erg.convert_relation_to_unk(*elements)
+            elif method == "u2r":
+                erg.convert_unk_to_relation(*elements)
+            update_schema_linking(erg)
+            decoder = SQLDecoder(erg.acdb, values)
+            ast = decoder.tree
+            unparser = Unparser(ast)
+            new_query = unparser.get_face_code()
+
+            new_db = acdb.to_dict()
+            new_sql = self.get_new_sql(ast, new_db, new_query)
+
+            gen_log = method + f"[{','.join(elements)}]"
+            new_data = {
+                "question": data["question"],
+                "question_toks": data["question_toks"],
+                "query": new_query,
+                "query_toks": new_query.split(" "),
+                "query_toks_no_value": new_query.split(" "),
+                "sql": new_sql,
+                "gen_log": gen_log
+            }
+            new_db_id = db_id + '_' + gen_log
+            new_data["db_id"] = new_db_id
+            new_db = self.compact(new_db, db_id)
+            new_db["db_id"] = new_db_id
+            results.append((method, new_data, new_db))
+        if transaction:
+            erg.commit()
+        return results
+
+    def get_new_sql(self, ast, new_db, new_query):
+        if self.sql_mode == "emit":
+            return Emitter(ast, new_db).get_sql()
+        new_sql = get_sql(Schema(new_db), new_query)
+        if self.sql_mode == "verify":
+            try:
+                emitted = Emitter(ast, new_db).get_sql()
+            except Exception as e:
+                self.sql_check["error"] += 1
+                self.sql_failures.append({"query": new_query, "db_id": new_db["db_id"], "error": repr(e)})
             else:
-                sql = data["sql"]
-                ori_encoder = SQLEncoder(db.copy())
-                ori_acdb, ori_values = ori_encoder.encode(sql)
-                ori_erg = ERG(ori_acdb, ori_values)
-                candidates = []
-                for method in ["e2a", "c2a", "r2u", "u2r"]:
-                    whitelist = filters[method](ori_erg, self.affected)
-                    for elements in whitelist:
-                        candidates.append([method, *elements])
+                if json.dumps(emitted) == json.dumps(new_sql):
+                    self.sql_check["match"] += 1
+                else:
+                    self.sql_check["mismatch"] += 1
+                    self.sql_failures.append({"query": new_query, "db_id": new_db["db_id"],
+                                              "emitted": emitted, "reparsed": new_sql})
+        return new_sql
+
+    def get_database(self, dbs, db_id):
+        """
+        Database of dbs[db_id], parsed once and shared by the examples of the db. It must only be read,
+        the encode cache copies it when an example is encoded
+        """
+        if self.databases is None or self.databases.tables is not dbs:
+            self.databases = DatabaseRegistry(dbs)
+        return self.databases[db_id]
+
+    def generate_all_example(self, dbs, data):
+        if data["question"] in self.BANQES:
+            return []
+        db = self.get_database(dbs, data["db_id"])
+        return self.generate_all_single(db, data)
+
+    def iter_generate_all(self, dbs, dataset, workers=1):
+        """
+        Yield the generated results of each example in dataset order, the counters are
+        updated in the same order so that the statistic does not depend on the number of workers
+        """
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=(self, dbs))
+            chunksize = max(1, min(64, len(dataset) // (workers * 8)))
+            results_iter = pool.imap(_generate_all_worker, dataset, chunksize=chunksize)
+        else:
+            pool = None
+            results_iter = (self.generate_all_example(dbs, data) for data in dataset)
+        try:
+            for results in results_iter:
                 flags = {"e2a": False, "c2a": False, "r2u": False, "u2r": False, "total": False}
-                for trans in candidates:
-                    method, *elements = trans
-                    sql = data["sql"]
-                    encoder = SQLEncoder(db.copy())
-                    acdb, values = encoder.encode(sql)
-                    erg = ERG(acdb, values)
-                    if method == "e2a":
-                        erg.convert_entity_to_attribute(*elements)
-                    elif method == "c2a":
-                        erg.convert_concept_to_attribute(*elements)
-                    elif method == "r2u":
-                        erg.convert_relation_to_unk(*elements)
-                    elif method == "u2r":
-                        erg.convert_unk_to_relation(*elements)
+                for method, new_data, new_db in results:
                     self.statistic[method] += 1
                     flags[method] = True
                     flags["total"] = True
-                    update_schema_linking(erg)
-                    decoder = SQLDecoder(erg.acdb, values)
-                    ast = decoder.tree
-                    unparser = Unparser(ast)
-                    new_query = unparser.get_face_code()
-
-                    new_db = acdb.to_dict()
-                    schema = Schema(new_db)
-                    new_sql = get_sql(schema, new_query)
-
-                    gen_log = method + f"[{','.join(elements)}]"
-                    new_data = {
-                        "question": data["question"],
-                        "question_toks": data["question_toks"],
-                        "query": new_query,
-                        "query_toks": new_query.split(" "),
-                        "query_toks_no_value": new_query.split(" "),
-                        "sql": new_sql,
-                        "gen_log": gen_log
-                    }
-                    new_db_id = db_id + '_' + gen_log
-                    new_data["db_id"] = new_db_id
-                    if new_db_id not in aug_db_ids:
-                        new_db["db_id"] = new_db_id
-                        aug_db_ids.append(new_db_id)
-                        aug_databases.append(new_db)
-                    aug_dataset.append(new_data)
                 for k in self.seed:
                     self.seed[k] += flags[k]
-            gc.collect()
+                yield results
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def generate_all(self, dbs, dataset, workers=1, aug_dataset=None, aug_databases=None, checkpoint=None,
+                     dedup=False):
+        """
+        aug_dataset and aug_databases can be any list-like sinks, e.g. JsonlWriter for streaming output,
+        with a checkpoint they must be the JsonlWriter opened by the checkpoint
+        :param dedup: examples whose generated database has the same contents as an emitted one point at its db_id
+        """
+        aug_dataset = [] if aug_dataset is None else aug_dataset
+        aug_databases = [] if aug_databases is None else aug_databases
+        self.dedup = DatabaseDeduplicator() if dedup else None
+        start, aug_db_ids = (0, set()) if checkpoint is None else checkpoint.restore(self)
+        for idx, results in enumerate(self.iter_generate_all(dbs, dataset[start:], workers), start):
+            for method, new_data, new_db in results:
+                if self.dedup is not None:
+                    new_data["db_id"] = new_db["db_id"] = self.dedup.resolve(new_data, new_db)
+                if new_data["db_id"] not in aug_db_ids:
+                    aug_db_ids.add(new_data["db_id"])
+                    aug_databases.append(new_db)
+                aug_dataset.append(new_data)
+            if checkpoint is not None and (idx + 1) % checkpoint.interval == 0:
+                checkpoint.save(idx + 1, self, aug_db_ids, aug_dataset, aug_databases)
 
         return aug_dataset, aug_databases
 
 
+_worker_generator = None
+_worker_dbs = None
+
+
+def _init_worker(generator, dbs):
+    global _worker_generator, _worker_dbs
+    _worker_generator = generator
+    _worker_dbs = dbs
+
+
+def _generate_all_worker(data):
+    return _worker_generator.generate_all_example(_worker_dbs, data)
+
+
+def benchmark(fn, *args, **kwargs):
+    """
+    Run fn under tracemalloc, return its result, the elapsed seconds and the peak traced memory in MB
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--data_path', type=str, required=True, help='dataset path')
@@ -270,14 +484,71 @@ if __name__ == '__main__':
     arg_parser.add_argument('--keep_original', action='store_true', help='whether keep original data')
     arg_parser.add_argument('--only_aug', action='store_true', help='only store augment data')
     arg_parser.add_argument('--gen_all', action='store_true', help='whether generate all possible data')
+    arg_parser.add_argument('--workers', type=int, default=1, help='number of processes used by --gen_all')
+    arg_parser.add_argument('--stream', action='store_true', help='write jsonl output while generating, only with --gen_all; '
+                                                                    'data_out and table_out get a .jsonl extension')
+    arg_parser.add_argument('--checkpoint_every', type=int, default=0, help='save progress every n examples, only with --gen_all')
+    arg_parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of data_out')
+    arg_parser.add_argument('--dedup', action='store_true', help='share the db_id of generated databases with identical contents')
+    arg_parser.add_argument('--emit_sql', action='store_true', help='build the sql dict from the decoded tree instead of reparsing the query')
+    arg_parser.add_argument('--verify_sql', action='store_true', help='check the emitted sql dict against the reparsed one, '
+                                                                      'differences are written to <data_out>.sql_check.json')
+    arg_parser.add_argument('--benchmark', action='store_true', help='report time and peak memory of --gen_all')
+    arg_parser.add_argument('--cell_store', type=str, help='cell value store of table_path (built if missing), '
+                                                           'output tables refer to it instead of copying cell values')
+    arg_parser.add_argument('--cell_root', type=str, help='directory output tables refer to --cell_store from, '
+                                                          'the current directory by default')
     args = arg_parser.parse_args()
-
-    generator = Generator(n_step=args.num_steps, affected=args.affected, keep_original=args.keep_original)
-    dbs = json.load(open(args.table_path, 'r'))
-    dbs = {db["db_id"]: db for db in dbs}
-    dataset = json.load(open(args.data_path, 'r'))
-    if args.gen_all:
-        aug_dataset, aug_databases = generator.generate_all(dbs, dataset)
+    if args.stream and not args.gen_all:
+        arg_parser.error('--stream requires --gen_all')
+    if (args.checkpoint_every > 0 or args.resume) and not args.gen_all:
+        arg_parser.error('--checkpoint_every and --resume require --gen_all')
+    if args.verify_sql and args.workers > 1:
+        arg_parser.error('--verify_sql counts in a single process, use --workers 1')
+    if args.benchmark and (not args.gen_all or args.stream or args.checkpoint_every > 0 or args.resume or args.workers > 1):
+        arg_parser.error('--benchmark only measures a plain single process --gen_all run')
+    if args.stream:
+        # streamed output is jsonl, name it so that find_jsonl and load_records pick it up
+        args.data_out, args.table_out = jsonl_counterpart(args.data_out), jsonl_counterpart(args.table_out)
+        print(f"Streaming to {args.data_out} and {args.table_out}")
+
+    sql_mode = "verify" if args.verify_sql else "emit" if args.emit_sql else "reparse"
+    dbs = load_tables(args.table_path)
+    cell_store = CellValueStore.open(args.cell_store, dbs, args.cell_root) if args.cell_store else None
+    generator = Generator(n_step=args.num_steps, affected=args.affected, keep_original=args.keep_original,
+                          sql_mode=sql_mode, cell_store=cell_store)
+    dataset = load_records(args.data_path)
+    if args.checkpoint_every > 0 or args.resume:
+        checkpoint = Checkpoint(args.data_out + '.ckpt', args.checkpoint_every if args.checkpoint_every > 0 else 100)
+        if args.resume:
+            checkpoint.load()
+        # without --stream the output is collected in jsonl part files and converted once finished
+        data_path = args.data_out if args.stream else args.data_out + '.part'
+        table_path = args.table_out if args.stream else args.table_out + '.part'
+        data_writer, table_writer = checkpoint.open(data_path, table_path)
+        with data_writer, table_writer:
+            aug_dataset, aug_databases = generator.generate_all(dbs, dataset, workers=args.workers,
+                                                                aug_dataset=data_writer,
+                                                                aug_databases=table_writer,
+                                                                checkpoint=checkpoint, dedup=args.dedup)
+        if not args.stream:
+            aug_dataset, aug_databases = list(iter_jsonl(data_path)), list(iter_jsonl(table_path))
+            os.remove(data_path)
+            os.remove(table_path)
+        checkpoint.clear()
+        args.only_aug = True
+    elif args.stream:
+        with JsonlWriter(args.data_out) as data_writer, JsonlWriter(args.table_out) as table_writer:
+            aug_dataset, aug_databases = generator.generate_all(dbs, dataset, workers=args.workers,
+                                                                aug_dataset=data_writer,
+                                                                aug_databases=table_writer, dedup=args.dedup)
+        args.only_aug = True
+    elif args.benchmark:
+        (aug_dataset, aug_databases), elapsed, peak = benchmark(generator.generate_all, dbs, dataset, dedup=args.dedup)
+        print(f"generate_all took {elapsed:.1f}s with a peak of {peak:.1f}MB traced memory")
+        args.only_aug = True
+    elif args.gen_all:
+        aug_dataset, aug_databases = generator.generate_all(dbs, dataset, workers=args.workers, dedup=args.dedup)
         args.only_aug = True
     else:
         aug_dataset, aug_databases = generator.generate(dbs, dataset)
@@ -285,13 +556,19 @@ if __name__ == '__main__':
     print(generator.statistic)
     if args.gen_all:
         print(generator.seed)
+    if generator.dedup is not None:
+        print(generator.dedup.report())
+    if args.verify_sql:
+        print(generator.sql_check)
+        json.dump(generator.sql_failures, open(args.data_out + '.sql_check.json', 'w'), indent=4)
 
     if not args.only_aug:
         aug_dataset += dataset
         all_db_id = [db['db_id'] for db in aug_databases]
         for db_id in dbs:
             if db_id not in all_db_id:
-                aug_databases.append(dbs[db_id])
+                aug_databases.append(generator.compact(dbs[db_id], db_id))
 
-    json.dump(aug_dataset, open(args.data_out, 'w'), indent=4)
-    json.dump(aug_databases, open(args.table_out, 'w'), indent=4)
+    if not args.stream:
+        json.dump(aug_dataset, open(args.data_out, 'w'), indent=4)
+        json.dump(aug_databases, open(args.table_out, 'w'), indent=4)
\ No newline at end of file
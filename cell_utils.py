@@ -0,0 +1,170 @@
+import os, sys, json
+import mmap
+
+sys.path.append(os.path.dirname(__file__))
+
+_store_root = None
+
+
+def set_store_root(root):
+    """
+    Directory the "store" of a cell_source is relative to, None for the current directory
+    """
+    global _store_root
+    _store_root = None if root is None else os.path.abspath(root)
+
+
+def store_path(store):
+    """
+    Absolute path of the "store" of a cell_source, former absolute paths are kept as they are
+    """
+    return os.path.join(_store_root or os.getcwd(), store)
+
+
+class CellValueStore:
+    """
+    Columnar store of the cell values of the source databases. Each db has one file holding the json of its
+    columns back to back, index.json keeps the (offset, length) of every column. Files are mmap'd and a column
+    is only decoded when it is read, decoded columns are shared by all the databases which refer to them.
+    Compacted tables refer to the store by its path relative to root (the store root when None)
+    """
+
+    def __init__(self, path, root=None):
+        self.path = os.path.abspath(path)
+        self.root = None if root is None else os.path.abspath(root)
+        self.index = json.load(open(os.path.join(path, 'index.json'), 'r'))  # db_id -> [(offset, length)]
+        self._maps = {}
+        self._columns = {}  # (db_id, cid) -> decoded cell values
+        self._cids = {}  # db_id -> {json of a column: cid}
+
+    @classmethod
+    def build(cls, dbs, path, root=None):
+        """
+        Write the cell values of dbs (db_id -> table dict) to a store at path
+        """
+        os.makedirs(path, exist_ok=True)
+        index = {}
+        for db_id, db in dbs.items():
+            offsets, offset = [], 0
+            with open(cls.data_path(path, db_id), 'wb') as f:
+                for values in db['cell_values']:
+                    data = cls.dumps(values)
+                    f.write(data)
+                    offsets.append((offset, len(data)))
+                    offset += len(data)
+            index[db_id] = offsets
+        json.dump(index, open(os.path.join(path, 'index.json'), 'w'))
+        return cls(path, root)
+
+    @classmethod
+    def open(cls, path, dbs=None, root=None):
+        """
+        Open the store at path, it is built from dbs first when it does not exist yet
+        """
+        if dbs is not None and not os.path.exists(os.path.join(path, 'index.json')):
+            return cls.build(dbs, path, root)
+        return cls(path, root)
+
+    @property
+    def reference(self):
+        # the "store" of compacted tables
+        return os.path.relpath(self.path, self.root or _store_root or os.getcwd())
+
+    @staticmethod
+    def data_path(path, db_id):
+        return os.path.join(path, db_id + '.cells')
+
+    @staticmethod
+    def dumps(values):
+        return json.dumps(values, separators=(',', ':')).encode('utf-8')
+
+    def _map(self, db_id):
+        if db_id not in self._maps:
+            with open(self.data_path(self.path, db_id), 'rb') as f:
+                # mmap refuses empty files
+                self._maps[db_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        return self._maps[db_id]
+
+    def raw(self, db_id, cid):
+        offset, length = self.index[db_id][cid]
+        return self._map(db_id)[offset:offset + length]
+
+    def get(self, db_id, cid):
+        key = (db_id, cid)
+        if key not in self._columns:
+            self._columns[key] = json.loads(self.raw(db_id, cid))
+        return self._columns[key]
+
+    def compact(self, db_dict, db_id):
+        """
+        Replace the cell values of db_dict which are equal to a column of the source db db_id by the id of that
+        column, the result refers to the store through its "cell_source"
+        """
+        if db_id not in self.index:
+            return db_dict
+        if db_id not in self._cids:
+            cids = {}
+            for cid in range(len(self.index[db_id])):
+                cids.setdefault(bytes(self.raw(db_id, cid)), cid)
+            self._cids[db_id] = cids
+        cids = self._cids[db_id]
+        cell_values = []
+        for values in db_dict['cell_values']:
+            cid = cids.get(self.dumps(values)) if values else None
+            cell_values.append(values if cid is None else cid)
+        new = dict(db_dict)
+        new['cell_values'] = cell_values
+        new['cell_source'] = {'store': self.reference, 'db_id': db_id}
+        return new
+
+    def __getstate__(self):
+        # mmaps can not be pickled, e.g. for the workers of aug_system.py
+        return {'path': self.path, 'root': self.root, 'index': self.index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._maps, self._columns, self._cids = {}, {}, {}
+
+
+_stores = {}
+
+
+def get_store(path):
+    if path not in _stores:
+        _stores[path] = CellValueStore(path)
+    return _stores[path]
+
+
+class CellRef:
+    """
+    Column cid of the source db db_id in the store at the absolute path, it is only read when resolved
+    """
+    __slots__ = ('path', 'db_id', 'cid')
+
+    def __init__(self, path, db_id, cid):
+        self.path = path
+        self.db_id = db_id
+        self.cid = cid
+
+    def resolve(self):
+        return get_store(self.path).get(self.db_id, self.cid)
+
+
+def column_cell_ref(db, cid):
+    """
+    Cell values of column cid of a table dict, or a CellRef when a compacted dict refers to its store
+    """
+    values = db['cell_values'][cid]
+    if isinstance(values, int):
+        source = db['cell_source']
+        return CellRef(store_path(source['store']), source['db_id'], values)
+    return values
+
+
+def column_cell_values(db, cid):
+    """
+    Cell values of column cid of a table dict, references of a compacted dict are resolved through its store,
+    which is found relative to the store root
+    """
+    values = column_cell_ref(db, cid)
+    return values.resolve() if isinstance(values, CellRef) else values
@@ -1,272 +1,415 @@
 import os, sys, json
 sys.path.append(os.path.dirname(__file__))
 from copy import deepcopy
+from sys import intern
+from bisect import bisect_left, insort
+from operator import add
 
 
 class PathCode:
+    """
+    Path of a code, node names are interned and kept in a tuple which is shared by copies,
+    the edit methods replace the tuple so that all holders of this object see the change
+    """
+    __slots__ = ('_path', '_string', '_hash')
 
     def __init__(self, path=None):
-        self.path = [] if path is None else path
+        self.path = () if path is None else path
+
+    @classmethod
+    def from_interned(cls, path):
+        # path is a tuple of interned names, e.g. taken from the stack of SQLEncoder
+        pc = cls.__new__(cls)
+        pc._path, pc._string, pc._hash = path, None, None
+        return pc
+
+    @property
+    def path(self):
+        return list(self._path)
+
+    @path.setter
+    def path(self, path):
+        self._set(tuple(intern(n) for n in path))
+
+    def _set(self, path):
+        self._path = path
+        self._string = None
+        self._hash = None
 
     def add(self, n):
-        self.path.append(n)
+        self._set(self._path + (intern(n),))
 
     @property
     def string(self):
-        return '-'.join(self.path)
+        if self._string is None:
+            self._string = '-'.join(self._path)
+        return self._string
 
     def copy(self, n=None):
-        pc = PathCode(deepcopy(self.path))
+        pc = PathCode.__new__(PathCode)
+        pc._path, pc._string, pc._hash = self._path, self._string, self._hash
         if n is not None:
             pc.add(n)
         return pc
 
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
     def __getitem__(self, item):
-        return self.path[item]
+        if isinstance(item, slice):
+            return list(self._path[item])
+        return self._path[item]
 
     def __len__(self):
-        return len(self.path)
+        return len(self._path)
 
     def __iter__(self):
-        yield from self.path
+        return iter(self._path)
+
+    def __contains__(self, item):
+        return item in self._path
 
     def __eq__(self, other):
-        return '-'.join(self.path) == '-'.join(other.path)
+        return self.string == other.string
 
     def insert(self, index, value):
-        self.path.insert(index, value)
+        path = list(self._path)
+        path.insert(index, intern(value))
+        self._set(tuple(path))
 
     def extend(self, ext):
-        self.path.extend(ext)
+        self._set(self._path + tuple(intern(n) for n in ext))
+
+    def edit(self, index, value):
+        path = list(self._path)
+        path[index] = intern(value)
+        self._set(tuple(path))
 
     def __hash__(self):
-        return '-'.join(self.path)
+        if self._hash is None:
+            self._hash = hash(self._path)
+        return self._hash
 
     def __repr__(self):
-        return "PathCode: " + '-'.join(self.path)
+        return "PathCode: " + self.string
 
 
 class BranchCode:
+    """
+    Branch indices of a code as a tuple of interned digit strings, see PathCode.
+    Equality is identity as before, only the hash depends on the content
+    """
+    __slots__ = ('_branch', '_string', '_hash')
 
     def __init__(self, branch=None):
-        self.branch = [] if branch is None else branch
+        self.branch = () if branch is None else branch
+
+    @classmethod
+    def from_interned(cls, branch):
+        bc = cls.__new__(cls)
+        bc._branch, bc._string, bc._hash = branch, None, None
+        return bc
+
+    @property
+    def branch(self):
+        return list(self._branch)
+
+    @branch.setter
+    def branch(self, branch):
+        self._set(tuple(intern(b) for b in branch))
+
+    def _set(self, branch):
+        self._branch = branch
+        self._string = None
+        self._hash = None
 
     def add(self, b):
-        self.branch.append(b)
+        self._set(self._branch + (intern(b),))
 
     @property
     def string(self):
-        return ''.join(self.branch)
+        if self._string is None:
+            self._string = ''.join(self._branch)
+        return self._string
 
     @property
     def value(self):
         return int('0b' + self.string, 2)
 
     def copy(self, b=None):
-        bc = BranchCode(deepcopy(self.branch))
+        bc = BranchCode.__new__(BranchCode)
+        bc._branch, bc._string, bc._hash = self._branch, self._string, self._hash
         if b is not None:
             bc.add(b)
         return bc
 
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
     def __getitem__(self, item):
-        return self.branch[item]
+        if isinstance(item, slice):
+            return list(self._branch[item])
+        return self._branch[item]
 
     def __len__(self):
-        return len(self.branch)
+        return len(self._branch)
 
     def __iter__(self):
-        yield from self.branch
+        return iter(self._branch)
 
     def insert(self, index, value):
-        self.branch.insert(index, value)
+        branch = list(self._branch)
+        branch.insert(index, intern(value))
+        self._set(tuple(branch))
 
     def extend(self, ext):
-        self.branch.extend(ext)
+        self._set(self._branch + tuple(intern(b) for b in ext))
 
     def edit(self, index, value):
-        self.branch[index] = value
+        branch = list(self._branch)
+        branch[index] = intern(value)
+        self._set(tuple(branch))
 
     def __hash__(self):
-        return '-'.join(self.branch)
+        if self._hash is None:
+            self._hash = hash(self._branch)
+        return self._hash
 
     def __repr__(self):
-        return "BranchCode: " + '-'.join(self.branch)
+        return "BranchCode: " + '-'.join(self._branch)
+
+
+class CodeIndex:
+    """
+    Sorted index over a list of (PathCode, BranchCode), keyed by the tokens node + branch so that a prefix is a
+    contiguous range. Queries return positions in list order, a code which appears several times is indexed at
+    each position. Codes edited in place must be passed to refresh()
+    """
+
+    def __init__(self, codes=()):
+        self.codes = list(codes)
+        self.tokens = [self._tokens(code) for code in self.codes]
+        self.keys = sorted(zip(self.tokens, range(len(self.tokens))))
+        self.holders = None  # id of a PathCode/BranchCode -> positions holding it, built on the first refresh
+        self.version = 0
+
+    @staticmethod
+    def _tokens(code):
+        path, branch = code
+        return tuple(map(add, path._path, branch._branch))
+
+    def _hold(self, pos):
+        for c in self.codes[pos]:
+            self.holders.setdefault(id(c), []).append(pos)
+
+    def append(self, code):
+        pos = len(self.codes)
+        self.codes.append(code)
+        self.tokens.append(self._tokens(code))
+        if self.holders is not None:
+            self._hold(pos)
+        insort(self.keys, (self.tokens[pos], pos))
+
+    def refresh(self, *codes):
+        """
+        Re-index every position holding one of the given PathCode/BranchCode objects after they were edited
+        """
+        if self.holders is None:
+            self.holders = {}
+            for pos in range(len(self.codes)):
+                self._hold(pos)
+        positions = set()
+        for c in codes:
+            positions.update(self.holders.get(id(c), ()))
+        for pos in positions:
+            del self.keys[bisect_left(self.keys, (self.tokens[pos], pos))]
+            self.tokens[pos] = self._tokens(self.codes[pos])
+            insort(self.keys, (self.tokens[pos], pos))
+        self.version += 1
+
+    def _range(self, low, high):
+        return sorted(pos for _, pos in self.keys[bisect_left(self.keys, (low,)):bisect_left(self.keys, (high,))])
+
+    def below(self, tokens):
+        # positions whose tokens start with the given ones
+        if len(tokens) == 0:
+            return list(range(len(self.codes)))
+        tokens = tuple(tokens)
+        return self._range(tokens, tokens[:-1] + (tokens[-1] + '\0',))
+
+    def starting_with(self, prefix):
+        # same as '-'.join(tokens).startswith('-'.join(prefix)), the last token of prefix may be partial
+        prefix = tuple(prefix)
+        return self._range(prefix, prefix[:-1] + (prefix[-1] + '\U0010ffff',))
+
+    def from_siblings(self, prefix):
+        # codes ending with a from node right below prefix
+        return [pos for pos in self.below(prefix)
+                if len(self.tokens[pos]) == len(prefix) + 1 and self.codes[pos][0][-1] == 'from']
+
+    def on_siblings(self, prefix):
+        # codes whose part before the first on node is prefix
+        return [pos for pos in self.below(prefix)
+                if len(self.codes[pos][0]) == len(prefix) or self.codes[pos][0][len(prefix)] == 'on']
+
+    def walk(self, query, *args):
+        """
+        Yield the positions of query(*args) in list order, the query is run again after a refresh() so that
+        codes edited by the caller are matched on their new tokens like in a plain scan of the list
+        """
+        version, pos, pending = None, -1, []
+        while True:
+            if version != self.version:
+                version = self.version
+                pending = [i for i in query(*args) if i > pos][::-1]
+            if len(pending) == 0:
+                return
+            pos = pending.pop()
+            yield pos
 
+    def __getitem__(self, item):
+        return self.codes[item]
 
-def reduce_from_branch(all_code, from_code):
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+
+def as_index(all_code):
+    return all_code if isinstance(all_code, CodeIndex) else CodeIndex(all_code)
+
+
+def code_prefix(path_code, branch_code, stop):
+    # tokens of a code before its first stop node
     prefix = []
+    for node, branch in zip(path_code, branch_code):
+        if node == stop:
+            break
+        prefix.append(node + branch)
+    return prefix
+
+
+def reduce_from_branch(all_code, from_code):
+    index = as_index(all_code)
     from_path_code, from_branch_code = from_code
-    for i in range(len(from_path_code) - 1):
-        prefix.append(from_path_code[i] + from_branch_code[i])
-    prefix.append("from")
-
-    for (path, branch) in all_code:
-        if path[-1] != 'from':
-            continue
-        tmp_path = []
-        for i in range(len(path) - 1):
-            tmp_path.append(path[i] + branch[i])
-        tmp_path.append("from")
-        if ('-'.join(tmp_path)) == ('-'.join(prefix)):
-            if int(branch[-1]) > int(from_branch_code[-1]):
-                branch.branch[-1] = str(int(branch[-1]) - 1)
+    prefix = [from_path_code[i] + from_branch_code[i] for i in range(len(from_path_code) - 1)]
+
+    for pos in index.walk(index.from_siblings, prefix):
+        path, branch = index[pos]
+        if int(branch[-1]) > int(from_branch_code[-1]):
+            branch.edit(-1, str(int(branch[-1]) - 1))
+            index.refresh(branch)
 
 
 def reduce_on_branch(all_code, on_code):
-    prefix = []
+    index = as_index(all_code)
     on_path_code, on_branch_code = on_code
-    for i, node in enumerate(on_path_code):
-        if node == "on":
-            break
-        else:
-            prefix.append(node + on_branch_code[i])
-    prefix.append("on")
-
-    for (path, branch) in all_code:
-        tmp_path = []
-        for i, node in enumerate(path):
-            if node == "on":
-                break
-            tmp_path.append(node + branch[i])
-        tmp_path.append("on")
-        if ('-'.join(tmp_path)) == ('-'.join(prefix)):
-            if int(branch[-3]) > int(on_branch_code[-3]):
-                branch.branch[-3] = str(int(branch[-3]) - 1)
+    prefix = code_prefix(on_path_code, on_branch_code, "on")
+
+    for pos in index.walk(index.on_siblings, prefix):
+        path, branch = index[pos]
+        if int(branch[-3]) > int(on_branch_code[-3]):
+            branch.edit(-3, str(int(branch[-3]) - 1))
+            index.refresh(branch)
 
 
 def add_from_code(all_code, on_code):
-    prefix = []
-    path_code, branch_code = [], []
+    index = as_index(all_code)
     on_path_code, on_branch_code = on_code
-    for i, node in enumerate(on_path_code):
-        if node == "on":
-            break
-        else:
-            prefix.append(node + on_branch_code[i])
-            path_code.append(node)
-            branch_code.append(on_branch_code[i])
-    prefix.append("from")
+    prefix = code_prefix(on_path_code, on_branch_code, "on")
+    path_code, branch_code = on_path_code[:len(prefix)], on_branch_code[:len(prefix)]
     max_idx = 0
-    for (path, branch) in all_code:
-        if path[-1] != 'from':
-            continue
-        tmp_path = []
-        for i in range(len(path) - 1):
-            tmp_path.append(path[i] + branch[i])
-        tmp_path.append("from")
-        if ('-'.join(tmp_path)) == ('-'.join(prefix)):
-            if int(branch[-1]) >= max_idx:
-                max_idx = int(branch[-1]) + 1
+    for pos in index.from_siblings(prefix):
+        path, branch = index[pos]
+        if int(branch[-1]) >= max_idx:
+            max_idx = int(branch[-1]) + 1
     path_code.append("from")
     branch_code.append(str(max_idx))
     return PathCode(path_code), BranchCode(branch_code)
 
 
 def add_on_code(all_code, on_code):
-    prefix = []
-    path_code, branch_code = [], []
+    index = as_index(all_code)
     on_path_code, on_branch_code = on_code
-    for i, node in enumerate(on_path_code):
-        if node == "on":
-            break
-        else:
-            prefix.append(node + on_branch_code[i])
-            path_code.append(node)
-            branch_code.append(on_branch_code[i])
-    prefix.append("on")
+    prefix = code_prefix(on_path_code, on_branch_code, "on")
+    path_code, branch_code = on_path_code[:len(prefix)], on_branch_code[:len(prefix)]
     max_idx = 0
-    for (path, branch) in all_code:
-        tmp_path = []
-        for i, node in enumerate(path):
-            if node == "on":
-                break
-            tmp_path.append(node + branch[i])
-        tmp_path.append("on")
-        if ('-'.join(tmp_path)) == ('-'.join(prefix)):
-            if int(branch[-3]) >= max_idx:
-                max_idx = int(branch[-3]) + 1
+    for pos in index.on_siblings(prefix):
+        path, branch = index[pos]
+        if int(branch[-3]) >= max_idx:
+            max_idx = int(branch[-3]) + 1
     path_code += ["on", "=", "Unary"]
     return PathCode(path_code), BranchCode(branch_code + [str(max_idx), "0", "0"]), BranchCode(branch_code + [str(max_idx), "1", "0"])
 
 
+def insert_and_node(index, maxprefix, maxprefix_wob, maxdeep, maxvalue, path_code):
+    # wrap the conditions below maxprefix which come after the insertion point into a new and node
+    for pos in index.walk(index.starting_with, maxprefix):
+        path, branch = index[pos]
+        prefix_windows = branch[len(path_code):len(path_code) + maxdeep]
+        if len(prefix_windows) > 0 and prefix_windows[-1] == '2':
+            prefix_windows[-1] = '1'
+        if maxdeep == 0 or \
+                (len(branch) >= len(path_code) + maxdeep and
+                 int('0b' + ''.join(prefix_windows), 2) >= maxvalue - 1):
+            path.insert(len(maxprefix_wob) - 1, "and")
+            branch.insert(len(maxprefix_wob) - 1, "0")
+            index.refresh(path, branch)
+
+
 def move_on_to_where(all_code, left_code, right_code):
-    prefix, prefix_wob = [], []
+    index = as_index(all_code)
     left_path_code, left_branch_code = left_code
     right_path_code, right_branch_code = right_code
-    for i, node in enumerate(left_path_code):
-        if node == "on":
-            break
-        else:
-            prefix.append(node + left_branch_code[i])
-            prefix_wob.append(node)
+    prefix = code_prefix(left_path_code, left_branch_code, "on")
+    prefix_wob = left_path_code[:len(prefix)]
     prefix.append("where0")
     prefix_wob.append("where")
-    maxprefix, maxprefix_wob, maxdeep, maxvalue = find_max_prefix(all_code, prefix, prefix_wob)
-
-    for (path, branch) in all_code:
-        tmp_path = deepcopy(path.path)
-        for i, node in enumerate(path):
-            tmp_path[i] += branch[i]
-        if '-'.join(tmp_path).startswith('-'.join(maxprefix)):
-            prefix_windows = branch[len(left_path_code):len(left_path_code) + maxdeep]
-            if len(prefix_windows) > 0 and prefix_windows[-1] == '2':
-                prefix_windows[-1] = '1'
-            if maxdeep == 0 or \
-                    (len(branch) >= len(left_path_code) + maxdeep and
-                     int('0b' + ''.join(prefix_windows), 2) >= maxvalue - 1):
-                path.insert(len(maxprefix_wob) - 1, "and")
-                branch.insert(len(maxprefix_wob) - 1, "0")
+    maxprefix, maxprefix_wob, maxdeep, maxvalue = find_max_prefix(index, prefix, prefix_wob)
+    insert_and_node(index, maxprefix, maxprefix_wob, maxdeep, maxvalue, left_path_code)
 
     if maxprefix_wob[-1] == "where":
         left_path_code.extend(['=', "Unary"])
-        left_branch_code.branch[-1] = '0'
+        left_branch_code.edit(-1, '0')
         left_branch_code.extend(['0', '0'])
         right_path_code.extend(['=', "Unary"])
-        right_branch_code.branch[-1] = '0'
+        right_branch_code.edit(-1, '0')
         right_branch_code.extend(['1', '0'])
     else:
         left_path_code.path = deepcopy(maxprefix_wob[:-1]) + ["and", "=", "Unary"]
         left_branch_code.branch = deepcopy(left_branch_code[:-1] + list('0' + bin(maxvalue)[2:-1] + "100"))
         right_path_code.path = deepcopy(maxprefix_wob[:-1]) + ["and", "=", "Unary"]
         right_branch_code.branch = deepcopy(right_branch_code[:-1] + list('0' + bin(maxvalue)[2:-1] + "110"))
+    index.refresh(left_path_code, left_branch_code, right_path_code, right_branch_code)
 
 
 def add_condition_to_where(all_code, from_code, value):
     from database_utils import Value
-    prefix, prefix_wob = [], []
+    index = as_index(all_code)
     from_path_code, from_branch_code = from_code
     cond_path_code, cond_branch_code = deepcopy(from_code)
-    for i, node in enumerate(from_path_code):
-        if node == "from" and i == len(from_path_code) - 1:
-            cond_path_code.path[i] = "where"
-            break
-        else:
-            prefix.append(node + from_branch_code[i])
-            prefix_wob.append(node)
+    prefix = [from_path_code[i] + from_branch_code[i] for i in range(len(from_path_code) - 1)]
+    prefix_wob = from_path_code[:-1]
+    if from_path_code[-1] == "from":
+        cond_path_code.edit(-1, "where")
+    else:
+        prefix.append(from_path_code[-1] + from_branch_code[-1])
+        prefix_wob.append(from_path_code[-1])
     prefix.append("where0")
     prefix_wob.append("where")
-    maxprefix, maxprefix_wob, maxdeep, maxvalue = find_max_prefix(all_code, prefix, prefix_wob)
-
-    for (path, branch) in all_code:
-        tmp_path = deepcopy(path.path)
-        for i, node in enumerate(path):
-            tmp_path[i] += branch[i]
-        # print('-'.join(tmp_path), '-'.join(maxprefix), branch.branch, maxdeep, maxvalue)
-        if '-'.join(tmp_path).startswith('-'.join(maxprefix)):
-            prefix_windows = branch[len(cond_path_code):len(cond_path_code) + maxdeep]
-            if len(prefix_windows) > 0 and prefix_windows[-1] == '2':
-                prefix_windows[-1] = '1'
-            if maxdeep == 0 or \
-                    (len(branch) >= len(cond_path_code) + maxdeep and
-                     int('0b' + ''.join(prefix_windows), 2) >= maxvalue - 1):
-                path.insert(len(maxprefix_wob) - 1, "and")
-                branch.insert(len(maxprefix_wob) - 1, "0")
-        # elif path == from_path_code:
-        #     if int(branch[-1]) > int(cond_branch_code[-1]):
-        #         branch.branch[-1] = str(int(branch[-1]) - 1)
+    maxprefix, maxprefix_wob, maxdeep, maxvalue = find_max_prefix(index, prefix, prefix_wob)
+    insert_and_node(index, maxprefix, maxprefix_wob, maxdeep, maxvalue, cond_path_code)
 
     if maxprefix_wob[-1] == "where":
-        cond_branch_code.branch[-1] = '0'
+        cond_branch_code.edit(-1, '0')
         value_path = cond_path_code.copy('=')
         value_branch = cond_branch_code.copy('1')
         cond_value = Value(value, value_path, value_branch)
@@ -283,44 +426,41 @@ def add_condition_to_where(all_code, from_code, value):
 
 
 def find_max_prefix(all_codes, prefix, prefix_wob):
+    index = as_index(all_codes)
     maxdeep = 0
     maxvalue = 0
     maxprefix = prefix
     maxprefix_wob = prefix_wob
-    for (path_code, branch_code) in all_codes:
-        tmp_path = deepcopy(path_code.path)
-        for i, (node, branch) in enumerate(zip(path_code, branch_code)):
-            tmp_path[i] += branch
-
-        if '-'.join(tmp_path).startswith('-'.join(prefix)):
-            where_clause_wob = path_code[len(prefix):]  # list of str
-            where_clause = tmp_path[len(prefix):]
-            i = 0
-            for node in where_clause_wob:
-                if node in ["unit", "union", "intersect", "except", "Unary", "Plus", "Minus", "Times", "Divide", "Count",
-                          "Avg", "Sum", "Min", "Max", "or"]:
-                    break
-                i += 1
-
-            if i == 1:  # where-cmp
-                maxprefix_wob = prefix_wob + [where_clause_wob[0]]
-                maxprefix = prefix + [where_clause[0]]
-                maxdeep = i
-                break
-            elif i == 0:  # where-or
-                maxprefix_wob = prefix_wob
-                maxprefix = prefix
-                maxdeep = i
+    for pos in index.starting_with(prefix):
+        path_code, branch_code = index[pos]
+        where_clause_wob = path_code[len(prefix):]  # list of str
+        where_clause = list(index.tokens[pos][len(prefix):])
+        i = 0
+        for node in where_clause_wob:
+            if node in ["unit", "union", "intersect", "except", "Unary", "Plus", "Minus", "Times", "Divide", "Count",
+                      "Avg", "Sum", "Min", "Max", "or"]:
                 break
-            prefix_windows = branch_code[len(prefix):len(prefix) + i]
-            if prefix_windows[-1] == '2':
-                prefix_windows[-1] = '1'
-            branch_value = int('0b' + ''.join(prefix_windows), 2)
-            if branch_value > maxvalue:
-                maxvalue = branch_value
-                maxdeep = i
-                maxprefix_wob = prefix_wob + where_clause_wob[:i]
-                maxprefix = prefix + where_clause[:i]
+            i += 1
+
+        if i == 1:  # where-cmp
+            maxprefix_wob = prefix_wob + [where_clause_wob[0]]
+            maxprefix = prefix + [where_clause[0]]
+            maxdeep = i
+            break
+        elif i == 0:  # where-or
+            maxprefix_wob = prefix_wob
+            maxprefix = prefix
+            maxdeep = i
+            break
+        prefix_windows = branch_code[len(prefix):len(prefix) + i]
+        if prefix_windows[-1] == '2':
+            prefix_windows[-1] = '1'
+        branch_value = int('0b' + ''.join(prefix_windows), 2)
+        if branch_value > maxvalue:
+            maxvalue = branch_value
+            maxdeep = i
+            maxprefix_wob = prefix_wob + where_clause_wob[:i]
+            maxprefix = prefix + where_clause[:i]
 
     maxprefix[-1] = maxprefix[-1][:-1]
 
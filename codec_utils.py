@@ -0,0 +1,124 @@
+import os, sys, json
+import argparse
+import time
+from multiprocessing import Pool
+
+sys.path.append(os.path.dirname(__file__))
+
+from database_utils import DatabaseRegistry
+from sql_parser import SQLEncoder
+from sql_unparser import SQLDecoder, Unparser
+
+
+class SQLCodec:
+    """
+    Batch round trip of sqls through SQLEncoder, SQLDecoder and Unparser. Databases are parsed once per db_id
+    by a DatabaseRegistry and only copied for each sql, times holds the seconds spent in each stage
+    """
+    STAGES = ('encode', 'decode', 'unparse')
+
+    def __init__(self, dbs, maxsize=32):
+        # dbs: a DatabaseRegistry, or db_id -> table dict / list of table dicts
+        self.dbs = dbs if isinstance(dbs, DatabaseRegistry) else DatabaseRegistry(dbs, maxsize)
+        self.times = dict.fromkeys(self.STAGES, 0.)
+        self.count = 0
+
+    def roundtrip(self, db, sql):
+        """
+        Unparsed query of sql, db is a db_id of dbs or a Database
+        """
+        query, times = self._roundtrip(db, sql)
+        self.add_times(times)
+        return query
+
+    def _roundtrip(self, db, sql):
+        db = self.dbs[db] if isinstance(db, str) else db
+        start = time.perf_counter()
+        dsg, values = SQLEncoder(db.copy()).encode(sql)
+        encoded = time.perf_counter()
+        tree = SQLDecoder(dsg, values).tree
+        decoded = time.perf_counter()
+        query = Unparser(tree).get_face_code()
+        end = time.perf_counter()
+        return query, (encoded - start, decoded - encoded, end - decoded)
+
+    def add_times(self, times):
+        for stage, seconds in zip(self.STAGES, times):
+            self.times[stage] += seconds
+        self.count += 1
+
+    def iter_roundtrip(self, pairs, workers=1, chunksize=16):
+        """
+        Yield the unparsed query of each (db, sql) pair of pairs in order. With workers > 1 the pairs are
+        spread over a process pool, every worker keeps its own registry so pairs should refer to db_ids
+        """
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=(self,))
+            results_iter = pool.imap(_roundtrip_worker, pairs, chunksize=chunksize)
+        else:
+            pool = None
+            results_iter = (self._roundtrip(db, sql) for db, sql in pairs)
+        try:
+            for query, times in results_iter:
+                self.add_times(times)
+                yield query
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def roundtrip_all(self, pairs, workers=1, chunksize=16):
+        return list(self.iter_roundtrip(pairs, workers, chunksize))
+
+    def report(self, elapsed=None):
+        total = sum(self.times.values())
+        lines = []
+        if elapsed is not None:
+            lines.append(f"{self.count} examples in {elapsed:.2f}s, {self.count / elapsed:.0f} examples/s")
+        for stage in self.STAGES:
+            share = self.times[stage] / total if total else 0.
+            lines.append(f"{stage}: {self.times[stage]:.3f}s ({share:.0%})")
+        return "\n".join(lines)
+
+
+def dataset_pairs(dataset):
+    return ((data["db_id"], data["sql"]) for data in dataset)
+
+
+def benchmark_codec(codec, dataset, workers=1):
+    """
+    Round trip every example of dataset, return the queries and the elapsed seconds
+    """
+    start = time.perf_counter()
+    queries = codec.roundtrip_all(dataset_pairs(dataset), workers)
+    return queries, time.perf_counter() - start
+
+
+_worker_codec = None
+
+
+def _init_worker(codec):
+    global _worker_codec
+    _worker_codec = codec
+
+
+def _roundtrip_worker(pair):
+    return _worker_codec._roundtrip(*pair)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--data_path', type=str, default='data/dev.json', help='dataset path')
+    arg_parser.add_argument('--table_path', type=str, default='data/tables_with_annots.json', help='table path')
+    arg_parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    arg_parser.add_argument('--output', type=str, help='write the unparsed queries to this file')
+    args = arg_parser.parse_args()
+
+    dataset = json.load(open(args.data_path, 'r'))
+    codec = SQLCodec(DatabaseRegistry.from_path(args.table_path))
+    queries, elapsed = benchmark_codec(codec, dataset, args.workers)
+    print(codec.report(elapsed))
+    if args.output:
+        with open(args.output, 'w') as f:
+            for query in queries:
+                f.write(query + '\n')
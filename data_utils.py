@@ -6,6 +6,7 @@ from collections import defaultdict
 sys.path.append(os.path.dirname(__file__))
 
 from eval.spider.process_sql import get_sql
+from cell_utils import column_cell_values
 
 
 class Schema:
@@ -345,6 +346,15 @@ def edit_table_type():
     print(num_relation/total)
 
 
+def table_agents():
+    # store the agents of every table, Database then reads them instead of detecting them. Run it again after
+    # editing the keys or columns of the tables, the stored agents are replaced
+    from database_utils import with_agents
+    dbs = json.load(open('data/tables_with_tags.json', 'r'))
+    dbs = [with_agents({k: v for k, v in db.items() if k != 'agents'}) for db in dbs]
+    json.dump(dbs, open('data/tables_with_tags.json', 'w'), indent=4)
+
+
 def correct_sample(dataset, dbs, db_id, query, new_query):
     for data in dataset:
         if data["db_id"] != db_id:
@@ -442,14 +452,14 @@ def construct_dbqa():
 def correct_value():
     tables = json.load(open(f'gendata/ets_affected_train/tables.json', 'r'))
     for did, db in enumerate(tables):
-        cell_values = db['cell_values']
+        # columns of a compacted table are shared with its store, the corrected values are new lists
+        cell_values = [column_cell_values(db, i) for i in range(len(db['cell_values']))]
         for i, col_val in enumerate(cell_values):
             if col_val is None:
                 tables[did]['cell_values'][i] = []
                 continue
-            for j, value in enumerate(col_val):
-                for k, token in enumerate(value):
-                    tables[did]['cell_values'][i][j][k] = token.replace('\"', '')
+            tables[did]['cell_values'][i] = [[token.replace('\"', '') for token in value] for value in col_val]
+        tables[did].pop('cell_source', None)
     json.dump(tables, open(f'gendata/ets_affected_train/tables.json', 'w'), indent=4)
 
 
@@ -504,6 +514,7 @@ if __name__ == '__main__':
     # correct_foreign_keys()
     # sample_fks_from_sql()
     # edit_table_type()
+    # table_agents()
     # correct_dataset()
     # import nltk
     # nltk.download('punkt')
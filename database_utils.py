@@ -1,11 +1,15 @@
 import os, sys, json
-from collections import defaultdict
+import hashlib
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
 from itertools import product
 from copy import deepcopy
 
 sys.path.append(os.path.dirname(__file__))
 
 from code_utils import PathCode, BranchCode
+from cell_utils import CellRef, column_cell_ref
+from jsonl_utils import load_tables, find_jsonl, JsonlTables
 
 
 class Schema:
@@ -70,10 +74,87 @@ def get_schema(db):
     return schema
 
 
+class NameIndex:
+    """
+    Index of a list of columns or tables by name, `item in index` is `item in items` without the scan. Only the
+    names are keys, Column.__eq__ also compares the tables of the candidates, so that renaming a table leaves the
+    index valid. Members hold the indexes they belong to and move themselves when they are renamed. Lists shorter
+    than MIN_SIZE are scanned instead
+    """
+    __slots__ = ('items', 'size', 'names')
+    MIN_SIZE = 32
+
+    def __init__(self, items):
+        self.items = items
+        self.size = 0
+        self.names = {}  # name -> members
+        for item in items:
+            self.add(item)
+
+    @classmethod
+    def of(cls, index, items):
+        # index while it covers items, else a new index of items (lists are only grown or replaced), None while
+        # items is short enough to be scanned
+        if index is None or index.items is not items or index.size != len(items):
+            if index is not None:
+                index.detach()
+            index = cls(items) if len(items) >= cls.MIN_SIZE else None
+        return index
+
+    def detach(self):
+        for members in self.names.values():
+            for member in members:
+                member._indexes.remove(self)
+        self.names = {}
+
+    def add(self, item):
+        self.link(item)
+        if item._indexes is None:
+            item._indexes = [self]
+        else:
+            item._indexes.append(self)
+        self.size += 1
+
+    def link(self, item):
+        self.names.setdefault(item._name, []).append(item)
+
+    def unlink(self, item):
+        members = self.names[item._name]
+        for i, member in enumerate(members):
+            if member is item:
+                del members[i]
+                break
+        if not members:
+            del self.names[item._name]
+
+    def __contains__(self, item):
+        for member in self.names.get(item._name, ()):
+            if member is item or member == item:
+                return True
+        return False
+
+
+def rename(item, name):
+    # name setter of Column and Table, the indexes holding item are kept up to date
+    indexes = item._indexes
+    if indexes is None:
+        item._name = name
+        return
+    for index in indexes:
+        index.unlink(item)
+    item._name = name
+    for index in indexes:
+        index.link(item)
+
+
 class Column:
+    __slots__ = ('_name', 'cid', 'table', 'nature', 'dtype', '_cell_values', 'is_pk', 'fk', 'path_code', 'branch_code',
+                 'cond_value', '_indexes')
+    SNAPSHOT_SKIP = ('_cell_values',)  # see erg_utils.StateSnapshot, cell values are shared and never modified
 
     def __init__(self, col, cid):
-        self.name = col  # original
+        self._name = col  # original
+        self._indexes = None  # NameIndex holding the column
         self.cid = cid
         self.table = None  # Table
         self.nature = None
@@ -85,6 +166,26 @@ class Column:
         self.branch_code = []
         self.cond_value = {}
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        rename(self, name)
+
+    @property
+    def cell_values(self):
+        # columns of a compacted table hold a CellRef until their values are first read
+        values = self._cell_values
+        if type(values) is CellRef:
+            values = self._cell_values = values.resolve()
+        return values
+
+    @cell_values.setter
+    def cell_values(self, values):
+        self._cell_values = values
+
     def add_path(self, path: PathCode):
         self.path_code.append(path)
 
@@ -110,27 +211,27 @@ class Column:
 
     @property
     def full_name(self):
-        if self.name == '*':
+        if self._name == '*':
             return '*'
         else:
-            return f"{self.table.name}.{self.name}"
+            return f"{self.table._name}.{self._name}"
 
     def copy(self):
         #  在外面补table,fk,cond_value
-        new = Column(self.name, self.cid)
+        new = Column(self._name, self.cid)
         new.nature = self.nature
         new.dtype = self.dtype
-        new.cell_values = self.cell_values
+        new._cell_values = self._cell_values
         new.is_pk = self.is_pk
         new.path_code = [p.copy() for p in self.path_code]
         new.branch_code = [b.copy() for b in self.branch_code]
         return new
 
     def __hash__(self):
-        return hash(self.name) ^ hash(self.table.name) ^ hash("Column")
+        return hash(self._name) ^ hash(self.table._name) ^ hash("Column")
 
     def __eq__(self, other):
-        return other.name == self.name and other.table == self.table
+        return other.name == self._name and other.table == self.table
 
     def __repr__(self):
         if self.name == "*":
@@ -140,9 +241,13 @@ class Column:
 
 
 class Table:
+    __slots__ = ('_name', 'tid', 'nature', 'dtype', 'columns', 'pks', 'fks', 'agents', 'path_code', 'branch_code', 'tag',
+                 '_indexes', '_column_index')
 
     def __init__(self, tab, tid):
-        self.name = tab
+        self._name = tab
+        self._indexes = None  # NameIndex holding the table
+        self._column_index = None  # NameIndex of columns, built by the first add_column
         self.tid = tid
         self.nature = None
         self.dtype = None
@@ -154,9 +259,20 @@ class Table:
         self.branch_code = []
         self.tag = None
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        rename(self, name)
+
     def add_column(self, column: Column):
-        if column not in self.columns:
+        index = self._column_index = NameIndex.of(self._column_index, self.columns)
+        if column not in (self.columns if index is None else index):
             self.columns.append(column)
+            if index is not None:
+                index.add(column)
 
     def add_path(self, path: PathCode):
         self.path_code.append(path)
@@ -174,7 +290,7 @@ class Table:
 
     def copy(self):
         #  在外面补columns,pks,fks,agents
-        new = Table(self.name, self.tid)
+        new = Table(self._name, self.tid)
         new.nature = self.nature
         new.dtype = self.dtype
         new.path_code = [p.copy() for p in self.path_code]
@@ -183,16 +299,17 @@ class Table:
         return new
 
     def __hash__(self):
-        return hash(self.name) ^ hash("Table")
+        return hash(self._name) ^ hash("Table")
 
     def __eq__(self, other):
-        return other.name == self.name
+        return other.name == self._name
 
     def __repr__(self):
         return f"Table: {self.name}"
 
 
 class Value:
+    __slots__ = ('value', 'path_code', 'branch_code')
 
     def __init__(self, value, path_code, branch_code):
         self.value = value
@@ -219,11 +336,82 @@ class Value:
         return Value(self.value, path_code, branch_code)
 
 
+class ColumnIndex:
+    """
+    Membership index with the semantics of `column in columns`, i.e. the same object or a column with the same name
+    in a table with the same name. The key of a member is taken when it is added, refresh() it after moving the column.
+    It does not follow renames, so it is built for one pass (e.g. schema linking), Database and Table keep a NameIndex
+    """
+
+    def __init__(self, columns=()):
+        self.members = {}  # id -> key
+        self.keys = defaultdict(int)
+        for column in columns:
+            self.add(column)
+
+    @staticmethod
+    def key(column):
+        return column._name, column.table._name if column.table is not None else None
+
+    def add(self, column):
+        key = self.key(column)
+        self.members[id(column)] = key
+        self.keys[key] += 1
+
+    def refresh(self, column):
+        key = self.key(column)
+        old = self.members[id(column)]
+        if old != key:
+            self.keys[old] -= 1
+            self.keys[key] += 1
+            self.members[id(column)] = key
+
+    def __contains__(self, column):
+        return id(column) in self.members or self.keys.get(self.key(column), 0) > 0
+
+
+class TableIndex(ColumnIndex):
+    """
+    Same for `table in tables`, tables are equal when their names are
+    """
+
+    @staticmethod
+    def key(table):
+        return table._name
+
+
+def detect_agents(table, columns=None, pks=None):
+    # columns and pks default to those of table, to_dict passes them in the order a Database of its dict has them
+    columns = table.columns if columns is None else columns
+    pks = table.pks if pks is None else pks
+    agents = []
+    for column in pks:
+        if column.dtype != "number":
+            agents.append(column)
+    if len(agents) == 0:
+        for column in columns:
+            if column.name.lower().replace('_', '') == table.name.lower().replace('_', ''):
+                agents.append(column)
+                break
+    if len(agents) == 0:
+        for column in columns:
+            if column.name.lower().replace('_', '') in ["name", "firstname", "lastname", "fname", "lname", "title"]:
+                agents.append(column)
+    if len(agents) == 0:
+        for column in columns:
+            if "name" in column.name.lower() or "title" in column.name.lower():
+                agents.append(column)
+    return agents
+
+
 class Database:
 
     def __init__(self, db=None):
         self.tables = []
         self.columns = []
+        self.table_index = None  # NameIndex of tables, built by the first add_table
+        self.column_index = None  # NameIndex of columns, built by the first add_column
+        self.shared = None  # ids of the tables (and table-less columns) a snapshot shares with its source
 
         if db is None:
             return
@@ -248,7 +436,7 @@ class Database:
             column = Column(col[1], cid)
             column.nature = column_names[cid][1]
             column.dtype = column_type[cid]
-            column.cell_values = db["cell_values"][cid]
+            column.cell_values = column_cell_ref(db, cid)
             if col[1] == '*':
                 column.table = None
             else:
@@ -272,58 +460,117 @@ class Database:
             primary_column.table.fks.append((primary_column, foreign_column))
             foreign_column.table.fks.append((primary_column, foreign_column))
 
-        for table in self.tables:
-            for column in table.pks:
-                if column.dtype != "number":
-                    table.agents.append(column)
-            if len(table.agents) == 0:
-                for column in table.columns:
-                    if column.name.lower().replace('_', '') == table.name.lower().replace('_', ''):
-                        table.agents.append(column)
-                        break
-            if len(table.agents) == 0:
-                for column in table.columns:
-                    if column.name.lower().replace('_', '') in ["name", "firstname", "lastname", "fname", "lname", "title"]:
-                        table.agents.append(column)
-            if len(table.agents) == 0:
-                for column in table.columns:
-                    if "name" in column.name.lower() or "title" in column.name.lower():
-                        table.agents.append(column)
+        # agent cids of every table, written by to_dict (or with_agents) so that they are detected once per schema
+        agents = db.get("agents")
+        for tid, table in enumerate(self.tables):
+            if agents is None:
+                table.agents.extend(detect_agents(table))
+            else:
+                table.agents.extend(self.columns[cid] for cid in agents[tid])
 
     def clear(self):
         self.tables = []
         self.columns = []
+        for index in (self.table_index, self.column_index):
+            if index is not None:
+                index.detach()
+        self.table_index = self.column_index = None
+
+    def add_column(self, column, check=True):
+        # check=False when the caller already knows the column is new, e.g. through a ColumnIndex, the index is
+        # then built again by the next checked call
+        index = None
+        if check:
+            index = self.column_index = NameIndex.of(self.column_index, self.columns)
+            if column in (self.columns if index is None else index):
+                return
+        column.cid = len(self.columns)
+        self.columns.append(column)
+        if index is not None:
+            index.add(column)
+
+    def add_table(self, table, check=True):
+        index = None
+        if check:
+            index = self.table_index = NameIndex.of(self.table_index, self.tables)
+            if table in (self.tables if index is None else index):
+                return
+        table.tid = len(self.tables)
+        self.tables.append(table)
+        if index is not None:
+            index.add(table)
+
+    def snapshot(self):
+        """
+        Database sharing the tables and columns of this one, a table is copied with its columns the first time
+        writable_table() or writable_column() returns it. References between a copied table and the shared ones
+        (fks, pks) only agree by name, as copy() re-links by name it gives a private Database with the same links
+        """
+        new = Database()
+        new.db_id = self.db_id
+        new.tables = list(self.tables)
+        new.columns = list(self.columns)
+        new.shared = {id(table) for table in self.tables}
+        new.shared.update(id(column) for column in self.columns if column.table is None)
+        return new
 
-    def add_column(self, column):
-        if column not in self.columns:
-            column.cid = len(self.columns)
-            self.columns.append(column)
-
-    def add_table(self, table):
-        if table not in self.tables:
-            table.tid = len(self.tables)
-            self.tables.append(table)
+    def writable_table(self, tid):
+        table = self.tables[tid]
+        if self.shared and id(table) in self.shared:
+            table = self.own(table)
+        return table
+
+    def writable_column(self, cid):
+        column = self.columns[cid]
+        if self.shared:
+            if column.table is None:
+                if id(column) in self.shared:
+                    self.shared.discard(id(column))
+                    column = self.columns[cid] = column.copy()
+            elif id(column.table) in self.shared:
+                self.own(column.table)
+                column = self.columns[cid]
+        return column
+
+    def own(self, table):
+        # replace a shared table and its columns by copies, links to the columns of other tables are kept
+        self.shared.discard(id(table))
+        new = table.copy()
+        columns = {}
+        for column in table.columns:
+            new_column = columns[id(column)] = column.copy()
+            new_column.table = new
+            new.columns.append(new_column)
+        for column in table.columns:
+            if column.fk is not None:
+                columns[id(column)].fk = columns.get(id(column.fk), column.fk)
+        new.pks = [columns.get(id(column), column) for column in table.pks]
+        new.agents = [columns.get(id(column), column) for column in table.agents]
+        new.fks = [(columns.get(id(p), p), columns.get(id(f), f)) for p, f in table.fks]
+        self.tables = [new if t is table else t for t in self.tables]
+        self.columns = [columns.get(id(column), column) for column in self.columns]
+        return new
 
     def copy(self):
         new = Database()
         new.db_id = self.db_id
         tables = {}
         for table in self.tables:
-            tables[table.name] = table.copy()
+            tables[table._name] = table.copy()
 
         columns = {}
         for column in self.columns:
             columns[column.full_name] = column.copy()
 
         for column in self.columns:
-            if column.name == "*":
+            if column._name == "*":
                 continue
             new_column = columns[column.full_name]
-            new_column.table = tables[column.table.name]
+            new_column.table = tables[column.table._name]
             new_column.fk = columns[column.fk.full_name] if column.fk is not None else None
 
         for table in self.tables:
-            new_table = tables[table.name]
+            new_table = tables[table._name]
             for column in table.columns:
                 new_table.columns.append(columns[column.full_name])
             for pk in table.pks:
@@ -351,29 +598,120 @@ class Database:
                    'tag': []}
 
         self.tables = sorted(self.tables, key=lambda x: x.tid)
+        foreign_keys = {}  # ordered set of (cid, cid)
         for table in self.tables:
-            db_dict["table_names_original"].append(table.name)
+            db_dict["table_names_original"].append(table._name)
             db_dict["table_names"].append(table.nature)
             db_dict["table_type"].append(table.dtype)
             db_dict["tag"].append(table.tag)
             for pk in table.pks:
                 db_dict["primary_keys"].append(pk.cid)
             for fk in table.fks:
-                if [fk[0].cid, fk[1].cid] not in db_dict["foreign_keys"]:
-                    db_dict["foreign_keys"].append([fk[0].cid, fk[1].cid])
+                foreign_keys[fk[0].cid, fk[1].cid] = None
+        db_dict["foreign_keys"] = [list(fk) for fk in foreign_keys]
 
         self.columns = sorted(self.columns, key=lambda x: x.cid)
         for column in self.columns:
             db_dict["cell_values"].append(column.cell_values)
-            if column.name == "*":
+            if column._name == "*":
                 db_dict["column_names_original"].append([-1, "*"])
                 db_dict["column_names"].append([-1, "*"])
             else:
-                db_dict["column_names_original"].append([column.table.tid, column.name])
+                db_dict["column_names_original"].append([column.table.tid, column._name])
                 db_dict["column_names"].append([column.table.tid, column.nature])
             db_dict["column_types"].append(column.dtype)
 
+        # the agents a Database of db_dict would detect, its tables list columns in cid order and pks in
+        # primary_keys order
+        columns = {table.tid: [] for table in self.tables}
+        pks = {table.tid: [] for table in self.tables}
+        for column in self.columns:
+            if column._name != "*":
+                columns[column.table.tid].append(column)
+        for cid in db_dict["primary_keys"]:
+            column = self.columns[cid]
+            pks[column.table.tid].append(column)
+        db_dict["agents"] = [[column.cid for column in detect_agents(table, columns[table.tid], pks[table.tid])]
+                             for table in self.tables]
+        return db_dict
+
+
+class DatabaseRegistry(Mapping):
+    """
+    Lazy db_id -> Database mapping over table dicts, a Database is built the first time its db_id is requested
+    and the maxsize most recently used ones are kept. A cached Database is returned while the stamp of its table
+    dict is unchanged. Returned databases are shared and must only be read, copy() them before encoding
+    """
+
+    def __init__(self, tables, maxsize=32):
+        # tables: db_id -> table dict (e.g. load_tables) or a list of table dicts
+        self.tables = tables if isinstance(tables, Mapping) else {db["db_id"]: db for db in tables}
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_path(cls, path, maxsize=32):
+        """
+        Registry of a table file, its .jsonl counterpart is preferred as it is read lazily
+        """
+        return cls(load_tables(find_jsonl(path)), maxsize)
+
+    def stamp(self, db_id):
+        """
+        Identifies the table dict of db_id without decoding it: its record in a jsonl table file, or the dict
+        itself when the tables are held in memory
+        """
+        if isinstance(self.tables, JsonlTables):
+            return self.tables.record(db_id)
+        return id(self.tables[db_id])
+
+    def __getitem__(self, db_id):
+        stamp = self.stamp(db_id)
+        entry = self.cache.get(db_id)
+        if entry is not None and entry[0] == stamp:
+            self.cache.move_to_end(db_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+            table = self.tables[db_id]
+            # the table dict is kept with its Database so that its id can not be reused while cached
+            entry = self.cache[db_id] = (stamp, table, Database(table))
+            self.cache.move_to_end(db_id)
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return entry[2]
+
+    def __contains__(self, db_id):
+        return db_id in self.tables
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+
+def with_agents(db_dict):
+    """
+    db_dict with the "agents" entry of Database.to_dict, detected once here instead of by every Database built
+    from it. db_dict itself is returned when it has the entry
+    """
+    if "agents" in db_dict:
         return db_dict
+    return dict(db_dict, agents=[[column.cid for column in table.agents] for table in Database(db_dict).tables])
+
+
+def database_hash(db_dict):
+    """
+    Canonical content hash of a database dict (the output of Database.to_dict), the db_id and the agents (which
+    follow from the rest) are ignored and keys are sorted so that databases with the same schema and contents share the hash
+    """
+    content = {k: v for k, v in db_dict.items() if k not in ('db_id', 'agents')}
+    content['primary_keys'] = sorted(content['primary_keys'])
+    content['foreign_keys'] = sorted(content['foreign_keys'])
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
 
 
 if __name__ == '__main__':
@@ -16,6 +16,7 @@ from eval.spider.process_sql import get_sql
 
 
 class ERG:
+    SNAPSHOT_SKIP = ('codes_cache',)  # see erg_utils.StateSnapshot
 
     def __init__(self, acdb: Database, values=None):
         self.acdb = acdb
@@ -26,6 +27,8 @@ class ERG:
         self.fault_tables = []
         self.fault_columns = []
         self.values = values
+        self.saved_state = None  # StateSnapshot taken by begin()
+        self.codes_cache = None  # CodeIndex returned by codes(), None when it has to be collected again
 
         self.build_graph()
 
@@ -107,6 +110,7 @@ class ERG:
         entity.add_attribute(new_attribute)
         self.entities.pop(concept)
         self.entities[new_concept] = entity
+        self.drop_codes_cache()
 
     def convert_entity_to_attribute(self, src, tgt):
         source_entity = self.entities[src]
@@ -118,6 +122,7 @@ class ERG:
 
         # self.move_relation_between_entities_to_where(source_entity, new_target_entity, values)
         remove_relation_between_entities(source_entity, new_target_entity)
+        self.drop_codes_cache()
 
         # 处理source.table
         tgt_codes = []
@@ -138,6 +143,7 @@ class ERG:
             if code not in tgt_codes:
                 new_target_entity.table.add_path(src_path_code)
                 new_target_entity.table.add_branch(src_branch_code)
+                self.drop_codes_cache()
             else:
                 reduce_from_branch(self.codes(), (src_path_code, src_branch_code))
 
@@ -195,6 +201,7 @@ class ERG:
                     new_target_entity.add_attribute(new_attribute)
                     new_target_entity.table.add_column(new_attribute)
                 edge_codes = sorted(edge_codes, key=lambda x: x[1][-3], reverse=True)
+                self.drop_codes_cache()
                 for code in edge_codes:
                     all_codes = self.codes()
                     reduce_on_branch(all_codes, code)
@@ -248,6 +255,7 @@ class ERG:
         self.entities.pop(src)
         self.entities.pop(tgt)
         self.entities[tgt] = new_target_entity
+        self.drop_codes_cache()
 
     def convert_relation_to_unk(self, direction, rel):
         relation = self.relations[rel]
@@ -317,6 +325,7 @@ class ERG:
             for p_code, b_code in copy_codes:
                 edge.start_joint.add_path(p_code)
                 edge.start_joint.add_branch(b_code)
+        self.drop_codes_cache()
         all_codes = self.codes()
         reduce_codes = sorted(reduce_codes, key=lambda x: x[1][-3], reverse=True)
         for code in reduce_codes:
@@ -340,9 +349,11 @@ class ERG:
             if f:
                 end_entity.table.add_path(path)
                 end_entity.table.add_branch(branch)
+                self.drop_codes_cache()
 
         self.directed_edges.extend(new_edges)
         self.relations.pop(rel)
+        self.drop_codes_cache()
 
     def convert_unk_to_relation(self, src, tgt):
         source_entity = self.entities[src]
@@ -372,7 +383,7 @@ class ERG:
             if len(list(edge.end_joint.codes)) > 0 and mode != "Add":
                 mode = "Replace"
             for path_code, branch_code in edge.end_joint.codes:
-                if "on" in path_code.path:
+                if "on" in path_code:
                     mode = "Add"
                     from_path, from_branch = add_from_code(all_code, (path_code, branch_code))
                     add_from_path.append(from_path)
@@ -442,12 +453,45 @@ class ERG:
         for i in remove_idx:
             self.directed_edges.pop(i)
         self.relations[relation.table.name] = relation
+        self.drop_codes_cache()
+
+    def begin(self):
+        """
+        Start a transaction, the graph, the database and the values can then be transformed
+        (and schema linked) and put back with rollback() to try another transformation on the same graph.
+        The whole state is copied, see StateSnapshot
+        """
+        assert self.saved_state is None, "transaction already started"
+        self.saved_state = StateSnapshot(self)
+
+    def commit(self):
+        self.saved_state = None
+
+    def rollback(self):
+        """
+        Restore the state at begin(), the transaction stays open so that it can be rolled back again
+        """
+        assert self.saved_state is not None, "no transaction to roll back"
+        saved_state = self.saved_state
+        saved_state.restore()
+        self.saved_state = saved_state
+        self.drop_codes_cache()
 
     def codes(self):
-        codes = collect_codes(self)
-        for value in self.values:
-            codes.append(value.codes)
-        return codes
+        """
+        CodeIndex of all codes, a cache kept between calls. The code_utils helpers refresh it when they rewrite
+        codes in place, but it is not maintained through structural edits: the transformations drop it when
+        codes are added, popped or moved, and the next call collects the codes of the whole graph again
+        """
+        if self.codes_cache is None:
+            codes = collect_codes(self)
+            for value in self.values:
+                codes.append(value.codes)
+            self.codes_cache = CodeIndex(codes)
+        return self.codes_cache
+
+    def drop_codes_cache(self):
+        self.codes_cache = None
 
 
 def collect_codes(erg: ERG):
@@ -479,27 +523,47 @@ def collect_codes(erg: ERG):
 
 
 def update_schema_linking(erg: ERG):
+    """
+    Rebuild erg.acdb from the graph, membership is checked through name-keyed indexes
+    instead of list scans so that the pass is linear in the size of the schema
+    """
+    erg.drop_codes_cache()
     erg.acdb.clear()
-    erg.acdb.add_column(erg.star)
+    tables, columns = set(), ColumnIndex()
+
+    def add_table(table):
+        if table.name not in tables:
+            tables.add(table.name)
+            erg.acdb.add_table(table, check=False)
+
+    def add_column(column):
+        if column in columns:
+            if id(column) in columns.members:
+                columns.refresh(column)
+        else:
+            columns.add(column)
+            erg.acdb.add_column(column, check=False)
+
+    add_column(erg.star)
 
     for ent in erg.entities:
         entity = erg.entities[ent]
         table = entity.table
         table.fks = []
         table.columns = []
-        erg.acdb.add_table(table)
+        add_table(table)
         for column in entity.primary + entity.agents:
             column.fk = None
             column.table = table
             # table.add_column(column)
-            erg.acdb.add_column(column)
+            add_column(column)
 
         for column in entity.attributes:
             column.is_pk = False
             column.fk = None
             column.table = table
             # table.add_column(column)
-            erg.acdb.add_column(column)
+            add_column(column)
 
         for edge_dict in entity.adjacent.values():
             forward = edge_dict["forward"]
@@ -511,14 +575,14 @@ def update_schema_linking(erg: ERG):
                 fedge.end_joint.table = fedge.end
                 fedge.end_joint.fk = fedge.start_joint
                 # fedge.end.add_column(fedge.end_joint)
-                erg.acdb.add_column(fedge.end_joint)
+                add_column(fedge.end_joint)
                 table.fks.append((fedge.start_joint, fedge.end_joint))
 
             for bedge in backward:
                 bedge.start_joint.table = bedge.start
                 bedge.end_joint.fk = bedge.start_joint
                 # bedge.start.add_column(bedge.start_joint)
-                erg.acdb.add_column(bedge.start_joint)
+                add_column(bedge.start_joint)
                 table.fks.append((bedge.start_joint, bedge.end_joint))
 
     for rel in erg.relations:
@@ -526,48 +590,59 @@ def update_schema_linking(erg: ERG):
         table = relation.table
         table.fks = []
         table.columns = []
-        erg.acdb.add_table(table)
+        add_table(table)
         for column in table.pks + table.agents:
             column.table = table
             # table.add_column(column)
-            erg.acdb.add_column(column)
+            add_column(column)
         for column in relation.attributes:
             column.table = table
             # table.add_column(column)
-            erg.acdb.add_column(column)
+            add_column(column)
 
         for edge in relation.left_fks + relation.right_fks:
             column = edge.end_joint
             column.table = table
             column.fk = edge.start_joint
             # table.add_column(column)
-            erg.acdb.add_column(column)
+            add_column(column)
             table.fks.append((edge.start_joint, edge.end_joint))
             edge.start.fks.append((edge.start_joint, edge.end_joint))
 
+    fk_names = {}  # id of a table -> full names of its fks
+
+    def add_fk(table, primary_column, foreign_column):
+        if id(table) not in fk_names:
+            fk_names[id(table)] = {p.full_name + f.full_name for (p, f) in table.fks}
+        name = primary_column.full_name + foreign_column.full_name
+        if name not in fk_names[id(table)]:
+            fk_names[id(table)].add(name)
+            table.fks.append((primary_column, foreign_column))
+
     for table in erg.fault_tables:
-        erg.acdb.add_table(table)
+        add_table(table)
         for primary_column, foreign_column in table.fks:
             primary_column.is_pk = True
             foreign_column.fk = primary_column
-            tmp_fks = [p.full_name + f.full_name for (p, f) in foreign_column.table.fks]
-            if primary_column.full_name + foreign_column.full_name not in tmp_fks:
-                foreign_column.table.fks.append((primary_column, foreign_column))
-            tmp_fks = [p.full_name + f.full_name for (p, f) in primary_column.table.fks]
-            if primary_column.full_name + foreign_column.full_name not in tmp_fks:
-                primary_column.table.fks.append((primary_column, foreign_column))
+            add_fk(foreign_column.table, primary_column, foreign_column)
+            add_fk(primary_column.table, primary_column, foreign_column)
     for column in erg.fault_columns:
-        erg.acdb.add_column(column)
+        add_column(column)
 
+    table_columns = {}  # id of a table -> index of its columns
     for column in erg.acdb.columns:
         if column.name != '*':
-            column.table.add_column(column)
+            table = column.table
+            if id(table) not in table_columns:
+                table_columns[id(table)] = ColumnIndex(table.columns)
+            if column not in table_columns[id(table)]:
+                table_columns[id(table)].add(column)
+                table.columns.append(column)
 
 
 def check_e2a(target):
     trains = json.load(open('data/dev.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -630,8 +705,7 @@ def check_e2a(target):
 
 def check_c2a(target):
     trains = json.load(open('data/dev.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -678,8 +752,7 @@ def check_c2a(target):
 
 def check_r2u(target):
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -726,8 +799,7 @@ def check_r2u(target):
 
 def check_u2r(target=None):
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -1,10 +1,11 @@
 import os, sys, json
 from collections import defaultdict
+from operator import attrgetter
 
 sys.path.append(os.path.dirname(__file__))
 
 from sql_parser import SQLEncoder
-from database_utils import Database, Column, Table
+from database_utils import Database, Column, Table, NameIndex
 from code_utils import *
 
 
@@ -16,12 +17,16 @@ class Entity:
         self.primary = table.pks  # list of Column
         self.agents = table.agents  # list of Column
         self.attributes = []
+        self.attribute_index = None  # NameIndex of attributes, built by the first add_attribute
         self.adjacent = {}  # node: edge
         self.hash_id = hash(self.table) ^ hash("Entity")
 
     def add_attribute(self, attr: Column):
-        if attr not in self.attributes:
+        index = self.attribute_index = NameIndex.of(self.attribute_index, self.attributes)
+        if attr not in (self.attributes if index is None else index):
             self.attributes.append(attr)
+            if index is not None:
+                index.add(attr)
 
     def delete_attribute(self, attr: Column):
         self.attributes.remove(attr)
@@ -100,10 +105,14 @@ class Relation:
         self.left_fks = []  # list of FKey
         self.right_fks = []  # list of FKey
         self.attributes = []  # list of Column
+        self.attribute_index = None  # NameIndex of attributes, built by the first add_attribute
 
     def add_attribute(self, attr: Column):
-        if attr not in self.attributes:
+        index = self.attribute_index = NameIndex.of(self.attribute_index, self.attributes)
+        if attr not in (self.attributes if index is None else index):
             self.attributes.append(attr)
+            if index is not None:
+                index.add(attr)
 
     def build_edges(self, entities: dict):
         edges = []
@@ -219,6 +228,81 @@ def check(db1, db2):
     return True
 
 
+class StateSnapshot:
+    """
+    Full copy of the state of every object and container reachable from a root (e.g. an ERG), restore() puts
+    all of them back in place so that references held elsewhere stay valid. It can be restored any number of
+    times. This is not an undo log: taking it and restoring it cost time and memory in the size of the whole
+    graph (about 150 objects and 0.5ms for a Spider ERG), however little a transformation changed.
+    A class lists in SNAPSHOT_SKIP the attributes whose value is restored but not traversed, i.e. contents which
+    are never modified by a transformation or which are rebuilt after a rollback
+    """
+    ATOMS = (str, int, float, bool, type(None))
+    SLOT_GETTERS = {}  # class with __slots__ -> attrgetter of all its slots
+
+    def __init__(self, root):
+        self.objects = []  # (object, attributes)
+        self.containers = []  # (list/dict/set, contents)
+        seen = set()
+        stack = [root]
+        atoms = self.ATOMS
+        while stack:
+            obj = stack.pop()
+            if type(obj) in atoms or id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            if type(obj) is list:
+                self.containers.append((obj, obj[:]))
+                stack.extend(obj)
+            elif type(obj) is tuple:
+                stack.extend(obj)
+            elif type(obj) is dict:
+                items = list(obj.items())
+                self.containers.append((obj, items))
+                stack.extend(obj)
+                stack.extend(obj.values())
+            elif type(obj) is set:
+                self.containers.append((obj, list(obj)))
+                stack.extend(obj)
+            else:
+                state = self.get_state(obj)
+                self.objects.append((obj, state))
+                skip = getattr(type(obj), "SNAPSHOT_SKIP", ())
+                for k, v in state.items():
+                    if type(v) not in atoms and k not in skip:
+                        stack.append(v)
+
+    @classmethod
+    def get_state(cls, obj):
+        if hasattr(obj, "__dict__"):
+            return dict(obj.__dict__)
+        names = type(obj).__slots__
+        getter = cls.SLOT_GETTERS.get(type(obj))
+        if getter is None:
+            # the first name is repeated so that the getter returns a tuple even for a single slot
+            getter = cls.SLOT_GETTERS[type(obj)] = attrgetter(*names, names[0])
+        try:
+            return dict(zip(names, getter(obj)))
+        except AttributeError:  # some slot is not set
+            return {name: getattr(obj, name) for name in names if hasattr(obj, name)}
+
+    def restore(self):
+        # attributes first, hash and eq of the keys depend on them (e.g. names) when dicts are refilled
+        for obj, state in self.objects:
+            if hasattr(obj, "__dict__"):
+                obj.__dict__.clear()
+                obj.__dict__.update(state)
+            else:
+                for name, value in state.items():
+                    setattr(obj, name, value)
+        for container, contents in self.containers:
+            if isinstance(container, list):
+                container[:] = contents
+            else:
+                container.clear()
+                container.update(contents)
+
+
 def remove_relation_between_entities(source: Entity, target: Entity):
     # src -> tgt
     edges = source.get_relation(target)
@@ -230,7 +314,7 @@ def remove_relation_between_entities(source: Entity, target: Entity):
             s_path, s_branch = src_codes[s]
             for t in range(len(tgt_codes) - 1, -1, -1):
                 t_path, t_branch = tgt_codes[t]
-                if 'on' in s_path.path and 'on' in t_path.path and s_path == t_path and s_branch.string[:-2] == t_branch.string[:-2]:
+                if 'on' in s_path and 'on' in t_path and s_path == t_path and s_branch.string[:-2] == t_branch.string[:-2]:
                     edge.start_joint.pop_code(s)
                     edge.end_joint.pop_code(t)
 
@@ -1,7 +1,8 @@
 import os, sys
 import json
 import sqlite3
-from nltk import word_tokenize
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from eval.spider.process_sql import mask_values, merge_comparison_ops, sql_word_tokenize
 
 CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group', 'order', 'limit', 'intersect', 'union', 'except')
 JOIN_KEYWORDS = ('join', 'on', 'as')
@@ -190,24 +191,10 @@ def get_schema_from_json(fpath):
 
 
 def tokenize(string):
-    string = str(string)
-    string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
-    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
-    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
-
-    # keep string value as token
-    vals = {}
-    for i in range(len(quote_idxs)-1, -1, -2):
-        qidx1 = quote_idxs[i-1]
-        qidx2 = quote_idxs[i]
-        val = string[qidx1: qidx2+1]
-        key = "__val_{}_{}__".format(qidx1, qidx2)
-        string = string[:qidx1] + key + string[qidx2+1:]
-        vals[key] = val
-
-    _toks = [word for word in word_tokenize(string)]
+    # same lexer as the spider evaluation, plus the [TABLE], [COLUMN] and [VALUE] placeholders
+    string, vals = mask_values(string)
     toks = []
-    for tok in _toks:
+    for tok in sql_word_tokenize(string):
         if tok == '[' or tok == ']':
             continue
         elif tok in ['TABLE', 'COLUMN', 'VALUE']:
@@ -215,20 +202,8 @@ def tokenize(string):
         else:
             toks.append(tok.lower())
     # replace with string value token
-    for i in range(len(toks)):
-        if toks[i] in vals:
-            toks[i] = vals[toks[i]]
-
-    # find if there exists !=, >=, <=
-    eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
-    eq_idxs.reverse()
-    prefix = ('!', '>', '<')
-    for eq_idx in eq_idxs:
-        pre_tok = toks[eq_idx-1]
-        if pre_tok in prefix:
-            toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1: ]
-
-    return toks
+    toks = [vals.get(tok, tok) for tok in toks]
+    return merge_comparison_ops(toks)
 
 
 def scan_alias(toks):
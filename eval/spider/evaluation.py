@@ -26,6 +26,13 @@ import sqlite3
 import traceback
 import argparse
 import warnings
+import re
+import time
+import hashlib
+import marshal
+import zlib
+from multiprocessing import Pool
+from urllib.request import pathname2url
 warnings.filterwarnings("ignore")
 
 install_path = os.path.abspath(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -480,7 +487,30 @@ def print_scores(scores, etype):
             print("{:20} {:<20.3f} {:<20.3f} {:<20.3f} {:<20.3f} {:<20.3f}".format(type_, *this_scores))
 
 
-def evaluate(gold, predict, db_dir, etype, kmaps, schemas=None):
+# db path -> (mtime of the sqlite file, Schema)
+_schema_cache = {}
+
+
+def load_schema(db):
+    """
+    Schema of the sqlite file db, cached per path and reloaded when the file is modified
+    """
+    mtime = os.path.getmtime(db) if os.path.exists(db) else None
+    cached = _schema_cache.get(db)
+    if cached is None or cached[0] != mtime:
+        cached = _schema_cache[db] = (mtime, Schema(get_schema(db)))
+    return cached[1]
+
+
+def evaluate(gold, predict, db_dir, etype, kmaps, schemas=None, exec_workers=1, gold_cache=None, connections=None,
+             exec_timeout=None, exec_max_rows=None):
+    """
+    :param exec_workers: with more than one worker the execution match runs on an ExecEngine
+    :param exec_timeout: seconds after which a prediction is interrupted and fails, on an ExecEngine only
+    :param exec_max_rows: a prediction which returns more rows fails, on an ExecEngine only
+    :param gold_cache: GoldResultCache of the gold query results
+    :param connections: ConnectionPool of read-only database snapshots, an ExecEngine uses one of the same mode
+    """
     with open(gold) as f:
         glist = [l.strip().split('\t') for l in f.readlines() if len(l.strip()) > 0]
 
@@ -503,13 +533,19 @@ def evaluate(gold, predict, db_dir, etype, kmaps, schemas=None):
             scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
 
     eval_err_num = 0
+    exec_engine = None
+    if exec_workers > 1 and etype in ["all", "exec"]:
+        exec_engine = ExecEngine(exec_workers, timeout=exec_timeout, max_rows=exec_max_rows,
+                                 gold_cache=None if gold_cache is None else gold_cache.path,
+                                 snapshot=None if connections is None else connections.mode)
+    exec_jobs, exec_hardness = [], []
     for p, g in zip(plist, glist):
         p_str = p[0]
         g_str, db = g
         db_name = db
         if schemas is None:
             db = os.path.join(db_dir, db, db + ".sqlite")
-            schema = Schema(get_schema(db))
+            schema = load_schema(db)
         else:
             schema = schemas[db]
         g_sql = get_sql(schema, g_str)
@@ -552,10 +588,14 @@ def evaluate(gold, predict, db_dir, etype, kmaps, schemas=None):
         p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
 
         if etype in ["all", "exec"]:
-            exec_score = eval_exec_match(db, p_str, g_str, p_sql, g_sql)
-            if exec_score:
-                scores[hardness]['exec'] += 1.0
-                scores['all']['exec'] += 1.0
+            if exec_engine is not None:
+                exec_jobs.append((db, p_str, g_str, select_val_units(p_sql), select_val_units(g_sql)))
+                exec_hardness.append(hardness)
+            else:
+                exec_score = eval_exec_match(db, p_str, g_str, p_sql, g_sql, gold_cache, connections)
+                if exec_score:
+                    scores[hardness]['exec'] += 1.0
+                    scores['all']['exec'] += 1.0
 
         if etype in ["all", "match"]:
             exact_score = evaluator.eval_exact_match(p_sql, g_sql)
@@ -590,6 +630,12 @@ def evaluate(gold, predict, db_dir, etype, kmaps, schemas=None):
                 'partial': partial_scores
             })
 
+    if exec_engine is not None:
+        for idx, exec_score in exec_engine.iter_results(exec_jobs):
+            if exec_score:
+                scores[exec_hardness[idx]]['exec'] += 1.0
+                scores['all']['exec'] += 1.0
+
     for level in levels:
         if scores[level]['count'] == 0:
             continue
@@ -620,24 +666,53 @@ def evaluate(gold, predict, db_dir, etype, kmaps, schemas=None):
     return scores['all']['exec'], scores['all']['exact']
 
 
-def eval_exec_match(db, p_str, g_str, pred, gold):
+def eval_exec_match(db, p_str, g_str, pred, gold, gold_cache=None, connections=None):
     """
     return 1 if the values between prediction and gold are matching
     in the corresponding index. Currently not support multiple col_unit(pairs).
+    A prediction which writes to a snapshot of connections is run again on a connection to the file
     """
-    conn = sqlite3.connect(db)
+    if connections is None:
+        conn = sqlite3.connect(db)
+    else:
+        try:
+            conn = connections.acquire(db)
+        except (sqlite3.Error, OSError):
+            return False
     cursor = conn.cursor()
     try:
         cursor.execute(p_str)
         p_res = cursor.fetchall()
-        cursor.execute(g_str)
-        q_res = cursor.fetchall()
+        if gold_cache is None or conn.in_transaction:
+            # the gold query sees the changes of a modifying prediction, its result can not be shared
+            cursor.execute(g_str)
+            q_res = cursor.fetchall()
+        else:
+            q_res = gold_cache.fetch(db, g_str, lambda sql: cursor.execute(sql).fetchall())
+    except sqlite3.OperationalError as e:
+        if connections is not None and ConnectionPool.is_write_error(e):
+            return eval_exec_match(db, p_str, g_str, pred, gold, gold_cache)
+        return False
     except:
         return False
+    finally:
+        if connections is not None:
+            connections.release(db, conn)
+        else:
+            # rolls back a modifying prediction, whose open transaction would otherwise lock the file
+            conn.close()
 
     # cursor.execute(g_str)
     # q_res = cursor.fetchall()
 
+    return exec_results_match(p_res, q_res, select_val_units(pred), select_val_units(gold))
+
+
+def select_val_units(sql):
+    return [unit[1] for unit in sql['select'][1]]
+
+
+def exec_results_match(p_res, q_res, p_val_units, q_val_units):
     def res_map(res, val_units):
         rmap = {}
         for idx, val_unit in enumerate(val_units):
@@ -645,11 +720,310 @@ def eval_exec_match(db, p_str, g_str, pred, gold):
             rmap[key] = [r[idx] for r in res]
         return rmap
 
-    p_val_units = [unit[1] for unit in pred['select'][1]]
-    q_val_units = [unit[1] for unit in gold['select'][1]]
     return res_map(p_res, p_val_units) == res_map(q_res, q_val_units)
 
 
+QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """
+    Collapse the whitespace outside of quoted literals and drop the trailing semicolon
+    """
+    parts = QUOTED_RE.split(sql)
+    # odd parts are the quoted literals
+    parts = [part if i % 2 else WHITESPACE_RE.sub(' ', part) for i, part in enumerate(parts)]
+    return ''.join(parts).strip().rstrip(';').rstrip()
+
+
+# db path -> (mtime, size, sha1 of the file)
+_db_hashes = {}
+
+
+def db_file_hash(db):
+    stat = os.stat(db)
+    cached = _db_hashes.get(db)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        sha1 = hashlib.sha1()
+        with open(db, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        cached = _db_hashes[db] = (stat.st_mtime_ns, stat.st_size, sha1.hexdigest())
+    return cached[2]
+
+
+class GoldResultCache:
+    """
+    Persistent cache of gold query results keyed by (sha1 of the db file, normalized sql), so that evaluating
+    another checkpoint only executes the predictions. The rows are stored marshal'd and zlib compressed in a
+    sqlite file, gold queries which fail are not cached
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, rows BLOB)')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(db, sql):
+        return db_file_hash(db) + '\t' + normalize_sql(sql)
+
+    def get(self, db, sql):
+        row = self.conn.execute('SELECT rows FROM results WHERE key = ?', (self.key(db, sql),)).fetchone()
+        return None if row is None else marshal.loads(zlib.decompress(row[0]))
+
+    def put(self, db, sql, rows):
+        try:
+            self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                              (self.key(db, sql), zlib.compress(marshal.dumps(rows))))
+            self.conn.commit()
+        except sqlite3.OperationalError:
+            # e.g. locked by another process for longer than the timeout, the result is cached next time
+            self.conn.rollback()
+
+    def fetch(self, db, sql, execute):
+        """
+        Rows of sql on db, execute(sql) is only called on a miss and its exceptions are propagated
+        """
+        rows = self.get(db, sql)
+        if rows is not None:
+            self.hits += 1
+            return rows
+        self.misses += 1
+        rows = execute(sql)
+        self.put(db, sql, rows)
+        return rows
+
+    def close(self):
+        self.conn.close()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+class ConnectionPool:
+    """
+    Read-only connections to snapshots of sqlite files. With mode 'memory' a file is read once into an in-memory
+    copy with the backup API and every connection is a backup of that copy, with mode 'immutable' the file is
+    opened with mode=ro&immutable=1 so that sqlite neither locks it nor checks it for changes. Released
+    connections are kept for reuse, the snapshots of a db are dropped when its file is modified.
+    Statements which write fail on a snapshot, see is_write_error
+    """
+    MODES = ('memory', 'immutable')
+
+    def __init__(self, mode='memory', maxsize=4):
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of {}'.format(self.MODES))
+        self.mode = mode
+        self.maxsize = maxsize  # idle connections kept per db
+        self.snapshots = {}  # db -> (mtime, size), in-memory copy or None
+        self.idle = {}  # db -> idle connections
+        self.stamps = {}  # connection -> (mtime, size) of the snapshot it was opened from
+
+    @staticmethod
+    def is_write_error(e):
+        # raised by a statement which writes, e.g. a modifying prediction, in both modes
+        return isinstance(e, sqlite3.OperationalError) and str(e).startswith('attempt to write a readonly database')
+
+    @staticmethod
+    def uri(db, mode):
+        return 'file:{}?{}'.format(pathname2url(os.path.abspath(db)), mode)
+
+    def _snapshot(self, db):
+        stat = os.stat(db)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if db not in self.snapshots or self.snapshots[db][0] != stamp:
+            for conn in self.idle.pop(db, []):
+                self._close(conn)
+            copy = None
+            if self.mode == 'memory':
+                source = sqlite3.connect(self.uri(db, 'mode=ro'), uri=True)
+                copy = sqlite3.connect(':memory:')
+                source.backup(copy)
+                source.close()
+            self.snapshots[db] = (stamp, copy)
+        return self.snapshots[db]
+
+    def _open(self, db, copy):
+        if self.mode == 'immutable':
+            return sqlite3.connect(self.uri(db, 'mode=ro&immutable=1'), uri=True)
+        conn = sqlite3.connect(':memory:')
+        copy.backup(conn)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def _close(self, conn):
+        self.stamps.pop(conn, None)
+        conn.close()
+
+    def acquire(self, db):
+        stamp, copy = self._snapshot(db)
+        idle = self.idle.setdefault(db, [])
+        conn = idle.pop() if idle else self._open(db, copy)
+        self.stamps[conn] = stamp
+        return conn
+
+    def release(self, db, conn):
+        conn.rollback()
+        conn.set_progress_handler(None, 0)
+        current = self.snapshots.get(db)
+        idle = self.idle.setdefault(db, [])
+        if current is not None and current[0] == self.stamps.get(conn) and len(idle) < self.maxsize:
+            idle.append(conn)
+        else:
+            self._close(conn)
+
+    def close(self):
+        for conns in self.idle.values():
+            for conn in conns:
+                self._close(conn)
+        for stamp, copy in self.snapshots.values():
+            if copy is not None:
+                copy.close()
+        self.idle, self.snapshots = {}, {}
+
+
+class ExecLimitExceeded(Exception):
+    pass
+
+
+class ExecEngine:
+    """
+    Execution match of many (db, p_str, g_str, p_val_units, q_val_units) jobs on a process pool. Jobs are grouped
+    by database so that the jobs of a db are run by the worker which keeps its connection open. A prediction can be
+    interrupted after timeout seconds or max_rows rows and then counts as failed like a query which raises, gold
+    queries are never limited. Without limits the scores are those of eval_exec_match
+    """
+
+    def __init__(self, workers=4, timeout=None, max_rows=None, chunksize=64, gold_cache=None, snapshot=None):
+        # gold_cache: path of a GoldResultCache, opened by every worker
+        # snapshot: mode of the ConnectionPool of every worker, by default the files are connected to directly
+        self.workers = workers
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.chunksize = chunksize
+        self.gold_cache = gold_cache
+        self.snapshot = snapshot
+
+    def tasks(self, jobs):
+        by_db = {}
+        for idx, job in enumerate(jobs):
+            by_db.setdefault(job[0], []).append((idx, job))
+        for db_jobs in by_db.values():
+            for i in range(0, len(db_jobs), self.chunksize):
+                yield db_jobs[i:i + self.chunksize], self.timeout, self.max_rows, self.gold_cache, self.snapshot
+
+    def iter_results(self, jobs):
+        """
+        Yield (index of the job, score) as soon as the chunk of the job is done, i.e. not in job order
+        """
+        pool = Pool(self.workers)
+        try:
+            for results in pool.imap_unordered(_exec_worker, self.tasks(jobs)):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self, jobs):
+        scores = [False] * len(jobs)
+        for idx, score in self.iter_results(jobs):
+            scores[idx] = score
+        return scores
+
+
+# db path -> connection of an ExecEngine worker
+_exec_connections = {}
+# path -> GoldResultCache of an ExecEngine worker
+_exec_gold_caches = {}
+# mode -> ConnectionPool of an ExecEngine worker
+_exec_pools = {}
+
+
+def _exec_query(conn, query, timeout, max_rows):
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    # a non zero return value interrupts the query, which raises sqlite3.OperationalError
+    conn.set_progress_handler(None if deadline is None else lambda: time.perf_counter() > deadline, 10000)
+    cursor = conn.cursor()
+    cursor.execute(query)
+    if max_rows is None:
+        return cursor.fetchall()
+    res = cursor.fetchmany(max_rows + 1)
+    if len(res) > max_rows:
+        raise ExecLimitExceeded(query)
+    return res
+
+
+def _exec_worker(task):
+    jobs, timeout, max_rows, gold_cache, snapshot = task
+    if gold_cache is not None:
+        if gold_cache not in _exec_gold_caches:
+            _exec_gold_caches[gold_cache] = GoldResultCache(gold_cache)
+        gold_cache = _exec_gold_caches[gold_cache]
+    pool = None
+    if snapshot is not None:
+        if snapshot not in _exec_pools:
+            _exec_pools[snapshot] = ConnectionPool(snapshot)
+        pool = _exec_pools[snapshot]
+    results = []
+    for idx, job in jobs:
+        score = None if pool is None else _exec_snapshot(pool, job, timeout, max_rows, gold_cache)
+        if score is None:
+            score = _exec_file(job, timeout, max_rows, gold_cache)
+        results.append((idx, score))
+    return results
+
+
+def _exec_job(conn, job, timeout, max_rows, gold_cache):
+    db, p_str, g_str, p_val_units, q_val_units = job
+    p_res = _exec_query(conn, p_str, timeout, max_rows)
+    if gold_cache is None or conn.in_transaction:
+        q_res = _exec_query(conn, g_str, None, None)
+    else:
+        q_res = gold_cache.fetch(db, g_str, lambda sql: _exec_query(conn, sql, None, None))
+    return exec_results_match(p_res, q_res, p_val_units, q_val_units)
+
+
+def _exec_snapshot(pool, job, timeout, max_rows, gold_cache):
+    # score of job on a snapshot of its db, None when the prediction writes and has to run on the file
+    db = job[0]
+    try:
+        conn = pool.acquire(db)
+    except (sqlite3.Error, OSError):
+        return False
+    try:
+        return _exec_job(conn, job, timeout, max_rows, gold_cache)
+    except sqlite3.OperationalError as e:
+        return None if ConnectionPool.is_write_error(e) else False
+    except:
+        return False
+    finally:
+        pool.release(db, conn)
+
+
+def _exec_file(job, timeout, max_rows, gold_cache):
+    db = job[0]
+    if db not in _exec_connections:
+        _exec_connections[db] = sqlite3.connect(db)
+    conn = _exec_connections[db]
+    try:
+        return _exec_job(conn, job, timeout, max_rows, gold_cache)
+    except:
+        return False
+    finally:
+        # a fresh connection per query never sees the changes of a previous one
+        conn.rollback()
+
+
 # Rebuild SQL functions for value evaluation
 def rebuild_cond_unit_val(cond_unit):
     if cond_unit is None or not DISABLE_VALUE:
@@ -848,12 +1222,39 @@ def build_foreign_key_map(entry):
     return foreign_key_map
 
 
-def build_foreign_key_map_from_json(table):
+def build_foreign_key_map_from_json(table, use_cache=False):
+    """
+    Foreign key maps of every db of the table file
+    :param use_cache: keep them next to the table file in <table>.kmaps.json, they are rebuilt when it changes
+    """
+    cache_path = table + '.kmaps.json'
+    stat = os.stat(table)
+    key = [stat.st_mtime, stat.st_size]
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache['key'] == key:
+                return cache['kmaps']
+        except (ValueError, KeyError):
+            pass
     with open(table) as f:
         data = json.load(f)
     tables = {}
     for entry in data:
         tables[entry['db_id']] = build_foreign_key_map(entry)
+    if use_cache:
+        # written to a temporary file first so that concurrent runs never read a partial cache
+        tmp_path = cache_path + '.%d' % os.getpid()
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'key': key, 'kmaps': tables}, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
     return tables
 
 
@@ -25,7 +25,9 @@
 ################################
 
 import json
+import re
 import sqlite3
+import time
 from nltk import word_tokenize
 import warnings
 warnings.filterwarnings("ignore")
@@ -115,7 +117,73 @@ def get_schema_from_json(fpath):
     return schema
 
 
+# Single pass equivalent of nltk word_tokenize on a sql whose quoted values are masked: brackets, comparison
+# signs and the characters below are tokens, a comma is one unless a digit follows, everything else is split
+# at whitespace only (e.g. "t1.name", "3.5", "a=b" stay whole)
+TOKEN_RE = re.compile(r"[()\[\]{}<>*;@#$%&?!]|,(?!\d)|(?:[^\s()\[\]{}<>*;@#$%&?!,]|,(?=\d))+")
+# Strings where TOKEN_RE may differ from word_tokenize, which then tokenizes them: non ascii or control
+# characters, the quote, colon, dash, ellipsis and contraction rules, a final period and whatever punkt could
+# take for the end of a sentence
+UNSAFE_RE = re.compile(r"[^\t\n\r\x20-\x7e]|[`:]|\.\.|--|,,|\.[\])}>\s]*$"
+                       r"|[.?!](?:[)\";}\]*:@'({\[!?]|\s+\S)"
+                       r"|(?i:\b(?:cannot|gimme|gonna|gotta|lemme|wanna)\b)")
+
+
+def sql_word_tokenize(string):
+    if UNSAFE_RE.search(string):
+        return word_tokenize(string)
+    return TOKEN_RE.findall(string)
+
+
+def mask_values(string):
+    """
+    Replace every quoted value by a key, the string uses double quotes only. Returns the string and key -> value
+    """
+    string = str(string)
+    string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
+    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
+    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
+
+    # keep string value as token
+    vals = {}
+    parts, last = [], 0
+    for qidx1, qidx2 in zip(quote_idxs[::2], quote_idxs[1::2]):
+        key = "__val_{}_{}__".format(qidx1, qidx2)
+        vals[key] = string[qidx1: qidx2+1]
+        parts.append(string[last:qidx1])
+        parts.append(key)
+        last = qidx2 + 1
+    parts.append(string[last:])
+    return ''.join(parts), vals
+
+
+def merge_comparison_ops(toks):
+    # find if there exists !=, >=, <=
+    prefix = ('!', '>', '<')
+    merged = toks[:1]
+    for tok in toks[1:]:
+        if tok == "=" and merged[-1] in prefix:
+            merged[-1] += "="
+        else:
+            merged.append(tok)
+    if merged and merged[0] == "=" and merged[-1] in prefix:
+        # a leading "=" was merged with the last token by the former implementation
+        merged = merged[:-1] + [merged[-1] + "="] + merged[1:]
+    return merged
+
+
 def tokenize(string):
+    string, vals = mask_values(string)
+    # replace with string value token
+    toks = [word.lower() for word in sql_word_tokenize(string)]
+    toks = [vals.get(tok, tok) for tok in toks]
+    return merge_comparison_ops(toks)
+
+
+def tokenize_reference(string):
+    """
+    The former tokenize, built on nltk word_tokenize, see compare_tokenizers
+    """
     string = str(string)
     string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
     quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
@@ -149,6 +217,26 @@ def tokenize(string):
     return toks
 
 
+def compare_tokenizers(queries):
+    """
+    Check that tokenize and tokenize_reference agree on every query and time both.
+    Returns the queries they disagree on
+    """
+    timings, results = {}, {}
+    for fn in (tokenize_reference, tokenize):
+        start = time.perf_counter()
+        results[fn.__name__] = [fn(query) for query in queries]
+        timings[fn.__name__] = time.perf_counter() - start
+    mismatches = [query for query, ref, toks in zip(queries, results['tokenize_reference'], results['tokenize'])
+                  if ref != toks]
+    fallbacks = sum(bool(UNSAFE_RE.search(mask_values(query)[0])) for query in queries)
+    for name, seconds in timings.items():
+        print("{}: {:.3f}s, {:.0f} queries/s".format(name, seconds, len(queries) / seconds))
+    print("speedup {:.1f}x, {} mismatches, {} queries tokenized by nltk".format(
+        timings['tokenize_reference'] / timings['tokenize'], len(mismatches), fallbacks))
+    return mismatches
+
+
 def scan_alias(toks):
     """Scan the index of 'as' and build the map for all alias"""
     as_idxs = [idx for idx, tok in enumerate(toks) if tok == 'as']
@@ -561,3 +649,18 @@ def skip_semicolon(toks, start_idx):
     while idx < len(toks) and toks[idx] == ";":
         idx += 1
     return idx
+
+
+if __name__ == '__main__':
+    # differential check of tokenize against the nltk based tokenize_reference over the spider queries
+    import argparse
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--data_paths', type=str, nargs='+', default=['data/train.json', 'data/dev.json'],
+                            help='datasets whose queries are tokenized')
+    args = arg_parser.parse_args()
+
+    queries = []
+    for data_path in args.data_paths:
+        queries.extend(data['query'] for data in json.load(open(data_path, 'r')))
+    for query in compare_tokenizers(queries):
+        print(query)
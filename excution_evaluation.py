@@ -1,4 +1,5 @@
 import os, sys, json, gc
+import argparse
 from shutil import copy
 import tempfile
 import sqlite3
@@ -6,27 +7,54 @@ from tqdm import tqdm
 
 sys.path.append(os.path.dirname(__file__))
 
-from eval.spider.evaluation import evaluate, build_foreign_key_map_from_json
+from eval.spider.evaluation import evaluate, build_foreign_key_map_from_json, GoldResultCache, ConnectionPool
 from eval.spider.process_sql import get_sql
-from database_utils import Database, Schema
-from sql_parser import SQLEncoder
+from database_utils import Database, DatabaseRegistry, Schema
+from sql_parser import EncodeCache
 from sql_unparser import SQLDecoder, Unparser
 from entity_relation_graph import ERG, update_schema_linking
 from qualifier import filter_for_c2a, filter_for_r2u, filter_for_u2r
 
 
-def eval_exec_match(p_db, g_db, p_str, g_str, pred, gold):
+def eval_exec_match(p_db, g_db, p_str, g_str, pred, gold, gold_cache=None, connections=None):
     """
     return 1 if the values between prediction and gold are matching
     in the corresponding index. Currently not support multiple col_unit(pairs).
+    :param connections: ConnectionPool of read-only snapshots of the gold databases. The prediction always runs on
+    the file, its database is rebuilt for every example and the prediction may write
     """
-    pconn = sqlite3.connect(os.path.join('data/new_database', p_db, p_db + '.sqlite'))
+    p_path = os.path.join('data/new_database', p_db, p_db + '.sqlite')
+    g_path = os.path.join('data/database', g_db, g_db + '.sqlite')
+    if connections is None:
+        gconn = sqlite3.connect(g_path)
+    else:
+        try:
+            gconn = connections.acquire(g_path)
+        except (sqlite3.Error, OSError):
+            # like a failing gold query
+            return True
+    pconn = sqlite3.connect(p_path)
+    try:
+        return exec_match(pconn, gconn, g_path, p_str, g_str, gold_cache)
+    finally:
+        # closing rolls back a modifying prediction, which would otherwise lock the file until it is rebuilt
+        pconn.close()
+        if connections is None:
+            gconn.close()
+        else:
+            connections.release(g_path, gconn)
+
+
+def exec_match(pconn, gconn, g_path, p_str, g_str, gold_cache=None):
     pcursor = pconn.cursor()
-    gconn = sqlite3.connect(os.path.join('data/database', g_db, g_db + '.sqlite'))
     gcursor = gconn.cursor()
+    g_exec = g_str.replace("DISTINCT", '').replace("Distinct", '').replace("distinct", '')
     try:
-        gcursor.execute(g_str.replace("DISTINCT", '').replace("Distinct", '').replace("distinct", ''))
-        q_res = gcursor.fetchall()
+        if gold_cache is None:
+            gcursor.execute(g_exec)
+            q_res = gcursor.fetchall()
+        else:
+            q_res = gold_cache.fetch(g_path, g_exec, lambda sql: gcursor.execute(sql).fetchall())
     except:
         return True
 
@@ -237,8 +265,8 @@ def build_single_for_r2u(db, new_db, src, tgt, rel):
 
 def get_samples_for_c2a():
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
+    encode_cache = EncodeCache()
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -252,24 +280,22 @@ def get_samples_for_c2a():
         question = data['question']
         total += 1
         db = dbs[db_id]
-        encoder = SQLEncoder(db.copy())
-        acdb, values = encoder.encode(sql)
+        acdb, values = encode_cache.encode(db, sql)
         erg = ERG(acdb, values)
 
         whitelist = filter_for_c2a(erg, used=True)
+        erg.begin()
         for ent, new_concept, concept_column in whitelist:
-            _acdb = acdb.copy()
-            _values = [v.copy() for v in values]
-            _erg = ERG(_acdb, _values)
-            new_value = _erg.entities[ent].table.nature
-            _erg.convert_concept_to_attribute(ent, new_concept, concept_column)
-
-            update_schema_linking(_erg)
-            decoder = SQLDecoder(_erg.acdb, _values)
+            erg.rollback()
+            new_value = erg.entities[ent].table.nature
+            erg.convert_concept_to_attribute(ent, new_concept, concept_column)
+
+            update_schema_linking(erg)
+            decoder = SQLDecoder(erg.acdb, values)
             ast = decoder.tree
             unparser = Unparser(ast)
             new_query = unparser.get_face_code()
-            new_db = _acdb.to_dict()
+            new_db = acdb.to_dict()
             schema = Schema(new_db)
             new_sql = get_sql(schema, new_query)
             golden.append(query)
@@ -283,13 +309,14 @@ def get_samples_for_c2a():
             # print(new_query)
             # print()
             gc.collect()
+        erg.commit()
     return golden, preds, golden_sql, pred_sql
 
 
 def get_samples_for_e2a():
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
+    encode_cache = EncodeCache()
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -303,18 +330,16 @@ def get_samples_for_e2a():
         question = data['question']
         total += 1
         db = dbs[db_id]
-        encoder = SQLEncoder(db.copy())
-        acdb, values = encoder.encode(sql)
+        acdb, values = encode_cache.encode(db, sql)
         erg = ERG(acdb, values)
 
         whitelist = filter_for_r2u(erg, used=True)
+        erg.begin()
         for direction, rel in whitelist:
             total += 1
-            _acdb = acdb.copy()
-            _values = [v.copy() for v in values]
-            _erg = ERG(_acdb, _values)
+            erg.rollback()
 
-            relation = _erg.relations[rel]
+            relation = erg.relations[rel]
 
             if direction == 'l2r':
                 src = relation.left.table.name
@@ -323,14 +348,14 @@ def get_samples_for_e2a():
                 src = relation.right.table.name
                 tgt = relation.left.table.name
 
-            _erg.convert_relation_to_unk(direction, rel)
+            erg.convert_relation_to_unk(direction, rel)
 
-            update_schema_linking(_erg)
-            decoder = SQLDecoder(_erg.acdb, _values)
+            update_schema_linking(erg)
+            decoder = SQLDecoder(erg.acdb, values)
             ast = decoder.tree
             unparser = Unparser(ast)
             new_query = unparser.get_face_code()
-            new_db = _acdb.to_dict()
+            new_db = acdb.to_dict()
             schema = Schema(new_db)
             new_sql = get_sql(schema, new_query)
             golden.append(query)
@@ -344,13 +369,14 @@ def get_samples_for_e2a():
             # print(new_query)
             # print()
             gc.collect()
+        erg.commit()
     return golden, preds, golden_sql, pred_sql
 
 
 def get_samples_for_u2r():
     trains = json.load(open('data/dev.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
+    encode_cache = EncodeCache()
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -364,25 +390,23 @@ def get_samples_for_u2r():
         question = data['question']
         total += 1
         db = dbs[db_id]
-        encoder = SQLEncoder(db.copy())
-        acdb, values = encoder.encode(sql)
+        acdb, values = encode_cache.encode(db, sql)
         erg = ERG(acdb, values)
 
         whitelist = filter_for_u2r(erg, used=True)
+        erg.begin()
         for src, tgt in whitelist:
             total += 1
-            _acdb = acdb.copy()
-            _values = [v.copy() for v in values]
-            _erg = ERG(_acdb, _values)
+            erg.rollback()
 
-            _erg.convert_unk_to_relation(src, tgt)
+            erg.convert_unk_to_relation(src, tgt)
 
-            update_schema_linking(_erg)
-            decoder = SQLDecoder(_erg.acdb, _values)
+            update_schema_linking(erg)
+            decoder = SQLDecoder(erg.acdb, values)
             ast = decoder.tree
             unparser = Unparser(ast)
             new_query = unparser.get_face_code()
-            new_db = _acdb.to_dict()
+            new_db = acdb.to_dict()
             schema = Schema(new_db)
             new_sql = get_sql(schema, new_query)
             golden.append(query)
@@ -396,13 +420,14 @@ def get_samples_for_u2r():
             # print(new_query)
             # print()
             gc.collect()
+        erg.commit()
     return golden, preds, golden_sql, pred_sql
 
 
 def get_samples_for_r2u():
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_tags.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_tags.json')
+    encode_cache = EncodeCache()
 
     corr, total = 0, 0
     golden, preds = [], []
@@ -416,18 +441,16 @@ def get_samples_for_r2u():
         question = data['question']
         total += 1
         db = dbs[db_id]
-        encoder = SQLEncoder(db.copy())
-        acdb, values = encoder.encode(sql)
+        acdb, values = encode_cache.encode(db, sql)
         erg = ERG(acdb, values)
 
         whitelist = filter_for_r2u(erg, used=True)
+        erg.begin()
         for direction, rel in whitelist:
             total += 1
-            _acdb = acdb.copy()
-            _values = [v.copy() for v in values]
-            _erg = ERG(_acdb, _values)
+            erg.rollback()
 
-            relation = _erg.relations[rel]
+            relation = erg.relations[rel]
 
             if direction == 'l2r':
                 src = relation.left.table.name
@@ -436,14 +459,14 @@ def get_samples_for_r2u():
                 src = relation.right.table.name
                 tgt = relation.left.table.name
 
-            _erg.convert_relation_to_unk(direction, rel)
+            erg.convert_relation_to_unk(direction, rel)
 
-            update_schema_linking(_erg)
-            decoder = SQLDecoder(_erg.acdb, _values)
+            update_schema_linking(erg)
+            decoder = SQLDecoder(erg.acdb, values)
             ast = decoder.tree
             unparser = Unparser(ast)
             new_query = unparser.get_face_code()
-            new_db = _acdb.to_dict()
+            new_db = acdb.to_dict()
             schema = Schema(new_db)
             new_sql = get_sql(schema, new_query)
             golden.append(query)
@@ -457,10 +480,11 @@ def get_samples_for_r2u():
             # print(new_query)
             # print()
             gc.collect()
+        erg.commit()
     return golden, preds, golden_sql, pred_sql
 
 
-def eval_for_c2a():
+def eval_for_c2a(gold_cache=None, connections=None):
     goldens, preds, golden_sql, pred_sql = get_samples_for_c2a()
     corr, total = 0, 0
     for i in range(len(goldens)):
@@ -472,12 +496,12 @@ def eval_for_c2a():
         p_str, p_db, ent, new_concept, concept_column, new_value = pred.split(' <=> ')
         build_single_for_c2a(g_db, p_db, ent, new_concept, concept_column, new_value)
         total += 1
-        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql)
+        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql, gold_cache, connections)
 
     print(corr, total)
 
 
-def eval_for_e2a():
+def eval_for_e2a(gold_cache=None, connections=None):
     goldens, preds, golden_sql, pred_sql = get_samples_for_r2u()
     corr, total = 0, 0
     for i in range(len(goldens)):
@@ -489,12 +513,12 @@ def eval_for_e2a():
         p_str, p_db, src, tgt, rel = pred.split(' <=> ')
         build_single_for_r2u(g_db, p_db, src, tgt, rel)
         total += 1
-        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql)
+        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql, gold_cache, connections)
 
     print(corr, total)
 
 
-def eval_for_u2r():
+def eval_for_u2r(gold_cache=None, connections=None):
     goldens, preds, golden_sql, pred_sql = get_samples_for_u2r()
     corr, total = 0, 0
     for i in range(len(goldens)):
@@ -506,12 +530,12 @@ def eval_for_u2r():
         p_str, p_db, src, tgt = pred.split(' <=> ')
         build_single_for_u2r(g_db, p_db, src, tgt)
         total += 1
-        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql)
+        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql, gold_cache, connections)
 
     print(corr, total)
 
 
-def eval_for_r2u():
+def eval_for_r2u(gold_cache=None, connections=None):
     goldens, preds, golden_sql, pred_sql = get_samples_for_r2u()
     corr, total = 0, 0
     for i in range(len(goldens)):
@@ -523,13 +547,21 @@ def eval_for_r2u():
         p_str, p_db, src, tgt, rel = pred.split(' <=> ')
         build_single_for_r2u(g_db, p_db, src, tgt, rel)
         total += 1
-        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql)
+        corr += eval_exec_match(p_db, g_db, p_str, g_str, p_sql, g_sql, gold_cache, connections)
 
     print(corr, total)
 
 
 if __name__ == '__main__':
-    # eval_for_c2a()
-    # eval_for_e2a()
-    eval_for_u2r()
-    # eval_for_r2u()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--gold_cache', type=str, default=None,
+                            help='sqlite file caching the gold query results across runs, e.g. data/gold_results.sqlite')
+    arg_parser.add_argument('--snapshots', type=str, default=None, choices=ConnectionPool.MODES,
+                            help='run the gold queries on read-only snapshots of the gold databases')
+    args = arg_parser.parse_args()
+    gold_cache = GoldResultCache(args.gold_cache) if args.gold_cache else None
+    connections = ConnectionPool(args.snapshots) if args.snapshots else None
+    # eval_for_c2a(gold_cache, connections)
+    # eval_for_e2a(gold_cache, connections)
+    eval_for_u2r(gold_cache, connections)
+    # eval_for_r2u(gold_cache, connections)
\ No newline at end of file
@@ -0,0 +1,222 @@
+import os, sys, json
+import random
+from collections.abc import Mapping
+
+sys.path.append(os.path.dirname(__file__))
+
+
+def is_jsonl(path):
+    return path.endswith('.jsonl')
+
+
+class JsonlWriter:
+    """
+    Append-only writer which stores one json record per line, records are written as soon as
+    they are produced so that the output never has to be held in memory
+    """
+
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self.fp = open(path, mode)
+        self.count = 0
+
+    @classmethod
+    def resume(cls, path, offset, count):
+        """
+        Reopen a partially written file, everything after offset (i.e. after the last checkpoint) is dropped
+        """
+        with open(path, 'r+') as f:
+            f.truncate(offset)
+        writer = cls(path, mode='a')
+        writer.count = count
+        return writer
+
+    def write(self, record):
+        self.fp.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def append(self, record):
+        # list-like interface, the writer can be used wherever a list of records is filled
+        self.write(record)
+
+    def flush(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_jsonl(path):
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class JsonlDataset:
+    """
+    Random access view of one or more jsonl files, only the byte offset of each record is kept in memory
+    and records are decoded on demand. A source may also be a list of records already in memory, so that
+    a dataset can be concatenated with a plain list
+    """
+
+    def __init__(self, paths=None, index=None):
+        self.paths = [] if paths is None else paths  # jsonl paths or lists of records
+        self.index = [] if index is None else index  # list of (file id, offset or position in the list)
+        self._fps = {}
+        self._pid = os.getpid()
+
+    @classmethod
+    def from_path(cls, path):
+        dataset = cls([path])
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    dataset.index.append((0, offset))
+                offset += len(line)
+        return dataset
+
+    @classmethod
+    def from_records(cls, records):
+        return cls([records], [(0, i) for i in range(len(records))])
+
+    def _read(self, fid, offset):
+        if not isinstance(self.paths[fid], str):
+            return self.paths[fid][offset]
+        if self._pid != os.getpid():
+            # file handles must not be shared with forked workers
+            self._fps, self._pid = {}, os.getpid()
+        if fid not in self._fps:
+            self._fps[fid] = open(self.paths[fid], 'rb')
+        fp = self._fps[fid]
+        fp.seek(offset)
+        return json.loads(fp.readline())
+
+    def shuffle(self, rng=random):
+        # consumes the random state exactly like shuffling a list of the same length
+        rng.shuffle(self.index)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return JsonlDataset(self.paths, self.index[item])
+        return self._read(*self.index[item])
+
+    def __add__(self, other):
+        if isinstance(other, list):
+            other = JsonlDataset.from_records(other)
+        if not isinstance(other, JsonlDataset):
+            return NotImplemented
+        # files are shared by path, record lists by identity
+        key = lambda p: p if isinstance(p, str) else id(p)
+        fids = {key(p): fid for fid, p in enumerate(self.paths)}
+        paths = list(self.paths)
+        for p in other.paths:
+            if key(p) not in fids:
+                fids[key(p)] = len(paths)
+                paths.append(p)
+        index = self.index + [(fids[key(other.paths[fid])], offset) for fid, offset in other.index]
+        return JsonlDataset(paths, index)
+
+    def __radd__(self, other):
+        if isinstance(other, list):
+            return JsonlDataset.from_records(other) + self
+        return NotImplemented
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for fid, offset in self.index:
+            yield self._read(fid, offset)
+
+    def close(self):
+        for fp in self._fps.values():
+            fp.close()
+        self._fps = {}
+
+
+class JsonlTables(Mapping):
+    """
+    Lazy db_id -> table dict mapping over a jsonl table file
+    """
+
+    def __init__(self, path, key='db_id'):
+        self.dataset = JsonlDataset([path])
+        self.offsets = {}
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    self.offsets[json.loads(line)[key]] = len(self.dataset.index)
+                    self.dataset.index.append((0, offset))
+                offset += len(line)
+
+    def __getitem__(self, item):
+        return self.dataset[self.offsets[item]]
+
+    def record(self, item):
+        # (file id, offset) of the table of item, identifies it without reading the file
+        return self.dataset.index[self.offsets[item]]
+
+    def __contains__(self, item):
+        return item in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+def load_records(path):
+    """
+    Load a list of records, jsonl files are opened lazily instead of being decoded at once
+    """
+    if is_jsonl(path):
+        return JsonlDataset.from_path(path)
+    return json.load(open(path, 'r'))
+
+
+def load_tables(path):
+    if is_jsonl(path):
+        return JsonlTables(path)
+    return {db['db_id']: db for db in json.load(open(path, 'r'))}
+
+
+def shuffle_records(records, rng=random):
+    if isinstance(records, JsonlDataset):
+        records.shuffle(rng)
+    else:
+        rng.shuffle(records)
+
+
+def jsonl_counterpart(path):
+    """
+    The .jsonl path written in place of a .json path, e.g. by aug_system.py --stream
+    """
+    return path if is_jsonl(path) else os.path.splitext(path)[0] + '.jsonl'
+
+
+def find_jsonl(path):
+    """
+    Return the .jsonl counterpart of a .json path when it exists, i.e. the output of aug_system.py --stream
+    """
+    jsonl_path = jsonl_counterpart(path)
+    if not is_jsonl(path) and os.path.exists(jsonl_path):
+        return jsonl_path
+    return path
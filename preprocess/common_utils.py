@@ -5,6 +5,7 @@ import stanza, torch
 import sqlite3
 from nltk.corpus import stopwords
 from itertools import product, combinations
+from cell_utils import column_cell_values
 
 MAX_RELATIVE_DIST = 2
 
@@ -333,7 +334,7 @@ class Preprocessor():
                 if i == 0 or 'id' in column_toks[i]: # ignore * and special token 'id'
                     continue
                 if 'cell_values' in db:
-                    cell_values = db['cell_values'][i]
+                    cell_values = column_cell_values(db, i)
                 else:
                     tab_name = db['table_names_original'][tab_id]
                     try:
@@ -5,6 +5,7 @@ from asdl.asdl import ASDLGrammar
 from asdl.transition_system import TransitionSystem
 from asdl.action_info import get_action_infos
 from preprocess.common_utils import Preprocessor
+from jsonl_utils import load_records
 
 def process_example(processor, entry, db, trans, verbose=False):
     # preprocess raw tokens, schema linking and subgraph extraction
@@ -60,14 +61,14 @@ if __name__ == '__main__':
     # loading database and dataset
     if args.raw_table_path:
         # need to preprocess database items
-        tables_list = json.load(open(args.raw_table_path, 'r'))
+        tables_list = load_records(args.raw_table_path)
         print('Firstly, preprocess the original databases ...')
         start_time = time.time()
         tables = process_tables(processor, tables_list, args.table_path, args.verbose)
         print('Databases preprocessing costs %.4fs .' % (time.time() - start_time))
     else:
         tables = pickle.load(open(args.table_path, 'rb'))
-    dataset = json.load(open(args.dataset_path, 'r'))
+    dataset = load_records(args.dataset_path)
     start_time = time.time()
     dataset = process_dataset(processor, dataset, tables, args.output_path, args.skip_large, verbose=args.verbose)
     print('Dataset preprocessing costs %.4fs .' % (time.time() - start_time))
@@ -77,7 +77,7 @@ def whitelist_for_r2u(relation_edges):
                     and edge.end.name == relation.table.name):
                 continue
             for path_code, branch_code in edge.end_joint.codes:
-                if "on" not in path_code.path:
+                if "on" not in path_code:
                     r2l = False
                     break
 
@@ -87,7 +87,7 @@ def whitelist_for_r2u(relation_edges):
                     edge.end.name == relation.table.name):  # unk
                 continue
             for path_code, branch_code in edge.end_joint.codes:
-                if "on" not in path_code.path:
+                if "on" not in path_code:
                     l2r = False
                     break
 
@@ -5,6 +5,12 @@ dev_path='data/dev.json'
 table_path='data/tables_with_tags.json'
 affected_root='gendata/all_generated_affected'
 imprevious_root='gendata/all_generated_imprevious'
+workers=${1:-1}
+# pass 'dedup' as the second argument to drop generated databases already seen in the same run
+dedup=''
+if [ "$2" = 'dedup' ]; then
+    dedup='--dedup'
+fi
 
 mkdir -p ${affected_root}
 mkdir -p ${imprevious_root}
@@ -16,7 +22,9 @@ python3 -u aug_system.py --data_path ${train_path} \
                          --table_out ${affected_root}'/train_tables.json' \
                          --num_steps 1 \
                          --affected \
-                         --gen_all
+                         --gen_all \
+                         ${dedup} \
+                         --workers ${workers}
 
 echo 'Generate all affected data for dev set'
 python3 -u aug_system.py --data_path ${dev_path} \
@@ -25,7 +33,9 @@ python3 -u aug_system.py --data_path ${dev_path} \
                          --table_out ${affected_root}'/dev_tables.json' \
                          --num_steps 1 \
                          --affected \
-                         --gen_all
+                         --gen_all \
+                         ${dedup} \
+                         --workers ${workers}
 
 echo 'Generate all imprevious data for train set'
 python3 -u aug_system.py --data_path ${train_path} \
@@ -33,7 +43,9 @@ python3 -u aug_system.py --data_path ${train_path} \
                          --data_out ${imprevious_root}'/train.json' \
                          --table_out ${imprevious_root}'/train_tables.json' \
                          --num_steps 1 \
-                         --gen_all
+                         --gen_all \
+                         ${dedup} \
+                         --workers ${workers}
 
 echo 'Generate all imprevious data for dev set'
 python3 -u aug_system.py --data_path ${dev_path} \
@@ -41,4 +53,6 @@ python3 -u aug_system.py --data_path ${dev_path} \
                          --data_out ${imprevious_root}'/dev.json' \
                          --table_out ${imprevious_root}'/dev_tables.json' \
                          --num_steps 1 \
-                         --gen_all
\ No newline at end of file
+                         --gen_all \
+                         ${dedup} \
+                         --workers ${workers}
\ No newline at end of file
@@ -1,11 +1,12 @@
 import os, sys, json
 import random
 import argparse
-from collections import defaultdict
+from collections import defaultdict, ChainMap
 
 sys.path.append(os.path.dirname(__file__))
 
 from eval.spider.evaluation import Evaluator
+from jsonl_utils import load_records, load_tables, find_jsonl, shuffle_records
 
 random.seed(42)
 
@@ -16,12 +17,12 @@ def sample_by_hardness(mode, method):
         os.mkdir(f'gendata/hardness_{method}_{mode}_1.0')
     ori_data = json.load(open(f'data/{mode}.json', 'r'))
     ori_tables = json.load(open('data/tables_with_tags.json', 'r'))
-    all_gen = json.load(open(f'gendata/all_generated_{method}/{mode}.json', 'r'))
-    gen_tables = json.load(open(f'gendata/all_generated_{method}/{mode}_tables.json', 'r'))
+    all_gen = load_records(find_jsonl(f'gendata/all_generated_{method}/{mode}.json'))
+    gen_tables = load_tables(find_jsonl(f'gendata/all_generated_{method}/{mode}_tables.json'))
     data_out = f'gendata/hardness_{method}_{mode}_1.0/{mode}.json'
     table_out = f'gendata/hardness_{method}_{mode}_1.0/tables.json'
 
-    all_tables = {db['db_id']: db for db in ori_tables + gen_tables}
+    all_tables = ChainMap(gen_tables, {db['db_id']: db for db in ori_tables})
     evaluator = Evaluator()
     ori_dist = {'easy': 0, 'medium': 0, 'hard': 0, 'extra': 0}
     for data in ori_data:
@@ -165,24 +166,21 @@ def sampling_for_augmentation(rate, method):
     ori_data = json.load(open(f'data/train.json', 'r'))
     ori_tables = json.load(open('data/tables_with_tags.json', 'r'))
     if method == 'mixed':
-        aff_gen = json.load(open(f'gendata/all_generated_affected/train.json', 'r'))
-        aff_tables = json.load(open(f'gendata/all_generated_affected/train_tables.json', 'r'))
-        imp_gen = json.load(open(f'gendata/all_generated_imprevious/train.json', 'r'))
-        imp_tables = json.load(open(f'gendata/all_generated_imprevious/train_tables.json', 'r'))
-        random.shuffle(imp_gen)
+        aff_gen = load_records(find_jsonl(f'gendata/all_generated_affected/train.json'))
+        aff_tables = load_tables(find_jsonl(f'gendata/all_generated_affected/train_tables.json'))
+        imp_gen = load_records(find_jsonl(f'gendata/all_generated_imprevious/train.json'))
+        imp_tables = load_tables(find_jsonl(f'gendata/all_generated_imprevious/train_tables.json'))
+        shuffle_records(imp_gen)
         all_gen = aff_gen + imp_gen[:len(aff_gen)]
-        random.shuffle(all_gen)
-        gen_tables = {db['db_id']: db for db in aff_tables}
-        imp_tables = {db['db_id']: db for db in imp_tables}
-        gen_tables.update(imp_tables)
-        gen_tables = list(gen_tables.values())
+        shuffle_records(all_gen)
+        gen_tables = ChainMap(imp_tables, aff_tables)
     else:
-        all_gen = json.load(open(f'gendata/all_generated_{method}/train.json', 'r'))
-        gen_tables = json.load(open(f'gendata/all_generated_{method}/train_tables.json', 'r'))
+        all_gen = load_records(find_jsonl(f'gendata/all_generated_{method}/train.json'))
+        gen_tables = load_tables(find_jsonl(f'gendata/all_generated_{method}/train_tables.json'))
     data_out = f'gendata/aug_{method}_{rate}/train.json'
     table_out = f'gendata/aug_{method}_{rate}/tables.json'
 
-    all_tables = {db['db_id']: db for db in ori_tables + gen_tables}
+    all_tables = ChainMap(gen_tables, {db['db_id']: db for db in ori_tables})
     evaluator = Evaluator()
     ori_dist = {'easy': 0, 'medium': 0, 'hard': 0, 'extra': 0}
     for data in ori_data:
@@ -201,6 +199,12 @@ def sampling_for_augmentation(rate, method):
         qes2idx[question].append(idx)
         idx2hdn[idx] = hardness
 
+    def fetch(idx):
+        # records of a jsonl dataset are decoded again on every access
+        data = all_gen[idx]
+        data['hardness'] = idx2hdn[idx]
+        return data
+
     new_dataset, new_tables = [], {}
     gen_dist = {'easy': 0, 'medium': 0, 'hard': 0, 'extra': 0}
     chosen = []
@@ -218,14 +222,15 @@ def sampling_for_augmentation(rate, method):
                     others.append(i)
             if len(candidate) > 0 and gen_dist[hardness] < ori_dist[hardness] * rate:
                 random.shuffle(candidate)
-                db_id = all_gen[candidate[0]]['db_id']
-                new_dataset.append(all_gen[candidate[0]])
+                sample = fetch(candidate[0])
+                db_id = sample['db_id']
+                new_dataset.append(sample)
                 new_tables[db_id] = all_tables[db_id]
                 gen_dist[hardness] += 1
                 chosen.append(candidate[0])
             elif len(others) > 0:
                 random.shuffle(others)
-                sample = all_gen[others[0]]
+                sample = fetch(others[0])
                 h = sample['hardness']
                 if gen_dist[h] < ori_dist[h] * rate:
                     db_id = sample['db_id']
@@ -239,9 +244,9 @@ def sampling_for_augmentation(rate, method):
         for idx in index_list:
             if idx in chosen:
                 continue
-            data = all_gen[idx]
-            hardness = data['hardness']
+            hardness = idx2hdn[idx]
             if gen_dist[hardness] < ori_dist[hardness] * rate:
+                data = fetch(idx)
                 db_id = data['db_id']
                 gen_dist[hardness] += 1
                 new_dataset.append(data)
@@ -268,31 +273,38 @@ def sampling_with_minimal_schema(rate, method):
     table_out = f'gendata_minschema/aug_{method}_{rate}/tables.json'
 
     if method == 'mixed':
-        aff_gen = json.load(open(f'gendata/all_generated_affected/train.json', 'r'))
-        aff_tables = json.load(open(f'gendata/all_generated_affected/train_tables.json', 'r'))
-        imp_gen = json.load(open(f'gendata/all_generated_imprevious/train.json', 'r'))
-        imp_tables = json.load(open(f'gendata/all_generated_imprevious/train_tables.json', 'r'))
-
-        gen_tables = {db['db_id']: db for db in aff_tables}
-        imp_tables = {db['db_id']: db for db in imp_tables}
-        gen_tables.update(imp_tables)
+        aff_gen = load_records(find_jsonl(f'gendata/all_generated_affected/train.json'))
+        aff_tables = load_tables(find_jsonl(f'gendata/all_generated_affected/train_tables.json'))
+        imp_gen = load_records(find_jsonl(f'gendata/all_generated_imprevious/train.json'))
+        imp_tables = load_tables(find_jsonl(f'gendata/all_generated_imprevious/train_tables.json'))
+
+        gen_tables = ChainMap(imp_tables, aff_tables)
         all_src_db = [db['db_id'] for db in ori_tables]
+        # only the indices of the records are grouped, records are fetched once they are sampled
         schema_data = defaultdict(dict)
-        for data in aff_gen:
+        for idx, data in enumerate(aff_gen):
             db_id = data['db_id']
             src = db_id.split('[')[0][:-4]
             assert src in all_src_db
             if db_id not in schema_data[src]:
                 schema_data[src][db_id] = {'affected': [], 'imprevious': []}
-            schema_data[src][db_id]['affected'].append(data)
-        for data in imp_gen:
+            schema_data[src][db_id]['affected'].append(idx)
+        for idx, data in enumerate(imp_gen):
             db_id = data['db_id']
-            data['source'] = 'imprevious'
             src = db_id.split('[')[0][:-4]
             assert src in all_src_db
             if db_id not in schema_data[src]:
                 schema_data[src][db_id] = {'affected': [], 'imprevious': []}
-            schema_data[src][db_id]['imprevious'].append(data)
+            schema_data[src][db_id]['imprevious'].append(idx)
+
+        def records_of(entry):
+            return [(aff_gen, idx) for idx in entry['affected']] + [(imp_gen, idx) for idx in entry['imprevious']]
+
+        def fetch(records, idx):
+            data = records[idx]
+            if records is imp_gen:
+                data['source'] = 'imprevious'
+            return data
 
         train_db_id = set()
         for data in ori_data:
@@ -311,7 +323,7 @@ def sampling_with_minimal_schema(rate, method):
             if len(_order) != 0:
                 random.shuffle(_order)
                 tgt = _order[0]
-                extend = schema_data[db_id][tgt]['affected'] + schema_data[db_id][tgt]['imprevious']
+                extend = records_of(schema_data[db_id][tgt])
                 aug_data.extend(extend[:100])
                 aug_tables.append(gen_tables[tgt])
                 chosen.append(tgt)
@@ -333,7 +345,7 @@ def sampling_with_minimal_schema(rate, method):
                         others.append((src, db_id))
             # random.shuffle(others)
             for src, db_id in others:
-                extend = schema_data[src][db_id]['affected'] + schema_data[src][db_id]['imprevious']
+                extend = records_of(schema_data[src][db_id])
                 aug_data.extend(extend[:100])
                 aug_tables.append(db_id)
                 num_db += 1
@@ -348,24 +360,23 @@ def sampling_with_minimal_schema(rate, method):
         else:
             random.shuffle(aug_data)
             aug_data = aug_data[:int(rate * len(ori_data))]
+        aug_data = [fetch(records, idx) for records, idx in aug_data]
         print(len(aug_data))
         print(len(aug_tables))
         print(num_aff, num_imp, num_db)
 
     else:
-        all_gen = json.load(open(f'gendata/all_generated_{method}/train.json', 'r'))
-        gen_tables = json.load(open(f'gendata/all_generated_{method}/train_tables.json', 'r'))
-
-        gen_tables = {db['db_id']: db for db in gen_tables}
+        all_gen = load_records(find_jsonl(f'gendata/all_generated_{method}/train.json'))
+        gen_tables = load_tables(find_jsonl(f'gendata/all_generated_{method}/train_tables.json'))
         all_src_db = [db['db_id'] for db in ori_tables]
         schema_data = defaultdict(dict)
-        for data in all_gen:
+        for idx, data in enumerate(all_gen):
             db_id = data['db_id']
             src = db_id.split('[')[0][:-4]
             assert src in all_src_db
             if db_id not in schema_data[src]:
                 schema_data[src][db_id] = []
-            schema_data[src][db_id].append(data)
+            schema_data[src][db_id].append(idx)
 
         train_db_id = set()
         for data in ori_data:
@@ -402,6 +413,7 @@ def sampling_with_minimal_schema(rate, method):
         else:
             random.shuffle(aug_data)
             aug_data = aug_data[:int(rate * len(ori_data))]
+        aug_data = [all_gen[idx] for idx in aug_data]
         print(len(aug_data))
         print(len(aug_tables))
 
@@ -1,5 +1,7 @@
 import os, sys, json
 from copy import deepcopy
+from collections import OrderedDict
+from sys import intern
 
 sys.path.append(os.path.dirname(__file__))
 
@@ -17,6 +19,11 @@ class TreeNode:
 
 
 class SQLEncoder:
+    """
+    Annotates the tables and columns of dsg with the codes of a sql in a single pass. The path and branch of
+    the current node are kept on one stack shared by all clauses and nested queries, codes are only built
+    for the tables, columns and values they are attached to
+    """
     AGG = [None, 'Max', 'Min', 'Count', 'Sum', 'Avg']
     UNITOP = ['Unary', 'Minus', 'Plus', 'Times', 'Divide']
     CMPOP = ('not', 'between', '=', '>', '<', '>=', '<=', '!=', 'in', 'like', 'is', 'exists')
@@ -24,50 +31,50 @@ class SQLEncoder:
     def __init__(self, dsg: Database, path_prefix: PathCode=None, branch_prefix: BranchCode=None):
 
         self.dsg = dsg
-        self.path_prefix = path_prefix if path_prefix is not None else PathCode()
-        self.branch_prefix = branch_prefix if branch_prefix is not None else BranchCode()
+        self.path = path_prefix.path if path_prefix is not None else []
+        self.branch = branch_prefix.branch if branch_prefix is not None else []
         self.tables = set()
         self.values = []
 
+    def push(self, n, b):
+        self.path.append(intern(n))
+        self.branch.append(intern(b))
+
+    def pop(self, k=1):
+        del self.path[-k:]
+        del self.branch[-k:]
+
+    def codes(self):
+        return PathCode.from_interned(tuple(self.path)), BranchCode.from_interned(tuple(self.branch))
+
     def encode(self, sql):
-        if sql["union"] is not None:
-            parser = SQLEncoder(self.dsg,
-                                path_prefix=self.path_prefix.copy("union"),
-                                branch_prefix=self.branch_prefix.copy('1'))
-            self.path_prefix.add("union")
-            self.branch_prefix.add('0')
-            dsg, values = parser.encode(sql["union"])
-            self.values.extend(values)
-
-        if sql["intersect"] is not None:
-            parser = SQLEncoder(self.dsg,
-                                path_prefix=self.path_prefix.copy("intersect"),
-                                branch_prefix=self.branch_prefix.copy('1'))
-            self.path_prefix.add("intersect")
-            self.branch_prefix.add('0')
-            dsg, values = parser.encode(sql["intersect"])
-            self.values.extend(values)
-
-        if sql["except"] is not None:
-            parser = SQLEncoder(self.dsg,
-                                path_prefix=self.path_prefix.copy("except"),
-                                branch_prefix=self.branch_prefix.copy('1'))
-            self.path_prefix.add("except")
-            self.branch_prefix.add('0')
-            dsg, values = parser.encode(sql["except"])
-            self.values.extend(values)
-
-        self.path_prefix.add("unit")
-        self.branch_prefix.add('0')
-        self.encode_sql_unit(sql)
+        self.encode_query(sql)
         return self.dsg, self.values
 
+    def encode_query(self, sql):
+        depth = 1
+        for op in ("union", "intersect", "except"):
+            if sql[op] is not None:
+                self.push(op, '1')
+                self.encode_query(sql[op])
+                self.pop()
+                # the left operand goes one level down for every set operation
+                self.push(op, '0')
+                depth += 1
+        self.push("unit", '0')
+        self.encode_sql_unit(sql)
+        self.pop(depth)
+
     def encode_sql_unit(self, sql_unit):
         self.encode_from(sql_unit['from'])
         if sql_unit['where']:
-            self.encode_where(sql_unit['where'])
+            self.push("where", '0')
+            self.encode_conds(sql_unit['where'])
+            self.pop()
         if sql_unit['having']:
-            self.encode_having(sql_unit['having'])
+            self.push("having", '0')
+            self.encode_conds(sql_unit['having'])
+            self.pop()
         if sql_unit['groupBy']:
             self.encode_groupby(sql_unit['groupBy'])
         if sql_unit['orderBy']:
@@ -75,71 +82,57 @@ class SQLEncoder:
         self.encode_select(sql_unit['select'])
 
     def encode_select(self, select_clause):
-        select_clause = select_clause[1]
-        for i, (agg_id, val_unit) in enumerate(select_clause):
+        for i, (agg_id, val_unit) in enumerate(select_clause[1]):
             agg = self.AGG[agg_id]
-            path_prefix = self.path_prefix.copy("select")
-            branch_prefix = self.branch_prefix.copy(str(i))
+            self.push("select", str(i))
             if agg is not None:
-                path_prefix.add(agg)
-                branch_prefix.add('0')
-            self.encode_val_unit(val_unit, path_prefix, branch_prefix)
+                self.push(agg, '0')
+                self.encode_val_unit(val_unit)
+                self.pop(2)
+            else:
+                self.encode_val_unit(val_unit)
+                self.pop()
 
     def encode_from(self, from_clause):
         table_units = from_clause['table_units']
-        t = table_units[0][0]
-        if t == 'table_unit':
+        if table_units[0][0] == 'table_unit':
             for i, tab_id in enumerate(table_units):
-                table = self.dsg.tables[tab_id[1]]
-                path = self.path_prefix.copy("from")
-                branch = self.branch_prefix.copy(str(i))
+                table = self.dsg.writable_table(tab_id[1])
+                self.push("from", str(i))
+                path, branch = self.codes()
+                self.pop()
                 table.add_path(path)
                 table.add_branch(branch)
                 self.tables.add(table.name)
         else:
-            parser = SQLEncoder(self.dsg,
-                                path_prefix=self.path_prefix.copy("from"),
-                                branch_prefix=self.branch_prefix.copy('0'))
-            dsg, values = parser.encode(table_units[0][1])
-            self.values.extend(values)
-
-        conds = from_clause['conds']
-        if len(conds) > 0:
-            cid = 0
-            for cond in conds:
-                if cond != "and":
-                    path_prefix = self.path_prefix.copy("on")
-                    branch_prefix = self.branch_prefix.copy(str(cid))
-                    self.encode_cond(cond, path_prefix, branch_prefix)
-                    cid += 1
-
-    def encode_where(self, where_clause):
-        path_prefix = self.path_prefix.copy("where")
-        branch_prefix = self.branch_prefix.copy('0')
-        self.encode_conds(where_clause, path_prefix, branch_prefix)
-
-    def encode_having(self, having_clause):
-        path_prefix = self.path_prefix.copy("having")
-        branch_prefix = self.branch_prefix.copy('0')
-        self.encode_conds(having_clause, path_prefix, branch_prefix)
+            self.push("from", '0')
+            self.encode_query(table_units[0][1])
+            self.pop()
+
+        cid = 0
+        for cond in from_clause['conds']:
+            if cond != "and":
+                self.push("on", str(cid))
+                self.encode_cond(cond)
+                self.pop()
+                cid += 1
 
     def encode_groupby(self, groupby_clause):
         for i, col_unit in enumerate(groupby_clause):
-            path_prefix = self.path_prefix.copy("groupby")
-            branch_prefix = self.branch_prefix.copy(str(i))
-            self.encode_col_unit(col_unit, path_prefix, branch_prefix)
+            self.push("groupby", str(i))
+            self.encode_col_unit(col_unit)
+            self.pop()
 
     def encode_orderby(self, orderby_clause, limit_clause):
-        order_str = orderby_clause[0]
-        limit_str = str(limit_clause) if limit_clause else ''
+        order_str = orderby_clause[0] + (str(limit_clause) if limit_clause else '')
+        self.push("orderby", '0')
         for i, val_unit in enumerate(orderby_clause[1]):
-            path_prefix = self.path_prefix.copy("orderby")
-            path_prefix.add(order_str + limit_str)
-            branch_prefix = self.branch_prefix.copy('0')
-            branch_prefix.add(str(i))
-            self.encode_val_unit(val_unit, path_prefix, branch_prefix)
+            self.push(order_str, str(i))
+            self.encode_val_unit(val_unit)
+            self.pop()
+        self.pop()
 
-    def encode_conds(self, conds, path_prefix, branch_prefix):
+    def encode_conds(self, conds):
         assert len(conds) > 0
         cond = conds[0]
         root = TreeNode(cond, True)
@@ -166,97 +159,114 @@ class SQLEncoder:
                 last = root
             else:
                 raise ValueError
+        self.encode_cond_tree(root)
 
-        queue = [root]
-        root.pc_buffer = path_prefix.copy()
-        root.bc_buffer = branch_prefix.copy()
-        while len(queue) > 0:
-            node = queue.pop()
-            if not node.isterminal:
-                node.left.pc_buffer = node.pc_buffer.copy(node.value)
-                node.left.bc_buffer = node.bc_buffer.copy('0')
-                node.right.pc_buffer = node.pc_buffer.copy(node.value)
-                node.right.bc_buffer = node.bc_buffer.copy('1')
-                queue.append(node.left)
-                queue.append(node.right)
-            else:
-                p_prefix = node.pc_buffer
-                b_prefix = node.bc_buffer
-                self.encode_cond(node.value, p_prefix, b_prefix)
+    def encode_cond_tree(self, node):
+        if node.isterminal:
+            self.encode_cond(node.value)
+        else:
+            # right operands first, in the order the conditions were always encoded
+            self.push(node.value, '1')
+            self.encode_cond_tree(node.right)
+            self.pop()
+            self.push(node.value, '0')
+            self.encode_cond_tree(node.left)
+            self.pop()
 
-    def encode_cond(self, cond, path_prefix, branch_prefix):
+    def add_value(self, value, b):
+        self.branch[-1] = intern(b)
+        path, branch = self.codes()
+        self.values.append(Value(value, path, branch))
+
+    def encode_cond(self, cond):
         not_op, cmp_op, val_unit, val1, val2 = cond
         op = self.CMPOP[cmp_op]
         if not_op:
             op = 'NotIn' if op == 'in' else 'NotLike'
+        self.push(op, '0')
         # SQL
         if isinstance(val1, dict):
-            val_path_prefix = path_prefix.copy(op)
-            val_branch_prefix = branch_prefix.copy('0')
-            self.encode_val_unit(val_unit, val_path_prefix, val_branch_prefix)
-
-            parser = SQLEncoder(self.dsg,
-                                path_prefix=path_prefix.copy(op),
-                                branch_prefix=branch_prefix.copy('1'))
-            dsg, values = parser.encode(val1)
-            self.values.extend(values)
+            self.encode_val_unit(val_unit)
+            self.branch[-1] = '1'
+            self.encode_query(val1)
             if val2 is not None:
-                value = Value(val2, path_prefix.copy(op), branch_prefix.copy('2'))
-                self.values.append(value)
+                self.add_value(val2, '2')
         # col op col
         elif isinstance(val1, list) or isinstance(val1, tuple):
-            col1_path_prefix = path_prefix.copy(op)
-            col1_branch_prefix = branch_prefix.copy('0')
-            self.encode_val_unit(val_unit, col1_path_prefix, col1_branch_prefix)
-            col2_path_prefix = path_prefix.copy(op)
-            col2_path_prefix.add("Unary")
-            col2_branch_prefix = branch_prefix.copy('1')
-            col2_branch_prefix.add('0')
-            self.encode_col_unit(val1, col2_path_prefix, col2_branch_prefix)
-
+            self.encode_val_unit(val_unit)
+            self.branch[-1] = '1'
+            self.push("Unary", '0')
+            self.encode_col_unit(val1)
+            self.pop()
         else:
-            p_prefix = path_prefix.copy(op)
-            b_prefix = branch_prefix.copy('0')
-            value = Value(val1, path_prefix.copy(op), branch_prefix.copy('1'))
-            self.values.append(value)
+            self.add_value(val1, '1')
             if val2 is not None:
-                value = Value(val2, path_prefix.copy(op), branch_prefix.copy('2'))
-                self.values.append(value)
-            self.encode_val_unit(val_unit, p_prefix, b_prefix)
+                self.add_value(val2, '2')
+            self.branch[-1] = '0'
+            self.encode_val_unit(val_unit)
+        self.pop()
 
-    def encode_val_unit(self, val_unit, path_prefix, branch_prefix):
+    def encode_val_unit(self, val_unit):
         unit_op, col_unit1, col_unit2 = val_unit
         if unit_op == 0:
-            p_prefix = path_prefix.copy("Unary")
-            b_prefix = branch_prefix.copy('0')
-            self.encode_col_unit(col_unit1, p_prefix, b_prefix)
+            self.push("Unary", '0')
+            self.encode_col_unit(col_unit1)
         else:
-            op = self.UNITOP[unit_op]
-            p_prefix1 = path_prefix.copy(op)
-            b_prefix1 = branch_prefix.copy('0')
-            p_prefix2 = path_prefix.copy(op)
-            b_prefix2 = branch_prefix.copy('1')
-            self.encode_col_unit(col_unit1, p_prefix1, b_prefix1)
-            self.encode_col_unit(col_unit2, p_prefix2, b_prefix2)
-
-    def encode_col_unit(self, col_unit, path_prefix, branch_prefix):
+            self.push(self.UNITOP[unit_op], '0')
+            self.encode_col_unit(col_unit1)
+            self.branch[-1] = '1'
+            self.encode_col_unit(col_unit2)
+        self.pop()
+
+    def encode_col_unit(self, col_unit):
         agg_id, col_id, distinct_flag = col_unit
         agg = self.AGG[agg_id]
         if agg is None:
-            path = path_prefix.copy()
-            branch = branch_prefix.copy()
+            path, branch = self.codes()
         else:
-            path = path_prefix.copy(agg)
-            branch = branch_prefix.copy('0')
-        column = self.dsg.columns[col_id]
+            self.push(agg, '0')
+            path, branch = self.codes()
+            self.pop()
+        column = self.dsg.writable_column(col_id)
         column.add_path(path)
         column.add_branch(branch)
 
 
+class EncodeCache:
+    """
+    Bounded LRU cache of encoded databases keyed by (db_id, sql), a snapshot of the database is annotated once
+    (only the tables the sql refers to are copied) and every lookup returns a private clone of the annotated
+    database and values, which can be transformed in place.
+    A db_id must always refer to the same schema, i.e. do not share a cache between generated databases
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, db: Database, sql):
+        key = (db.db_id, json.dumps(sql, sort_keys=True))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            encoder = SQLEncoder(db.snapshot())
+            self.cache[key] = encoder.encode(sql)
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        acdb, values = self.cache[key]
+        return acdb.copy(), [v.copy() for v in values]
+
+    def clear(self):
+        self.cache.clear()
+
+
 if __name__ == '__main__':
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_annots.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_annots.json')
     count = 0
     for i, data in enumerate(trains):
         sql = data["sql"]
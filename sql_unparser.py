@@ -4,7 +4,7 @@ from copy import deepcopy
 
 sys.path.append(os.path.dirname(__file__))
 
-from database_utils import Database
+from database_utils import Database, DatabaseRegistry
 from sql_parser import SQLEncoder
 from eval.spider.evaluation import evaluate, build_foreign_key_map_from_json
 
@@ -55,38 +55,87 @@ class Field:
 
 
 class SQLDecoder:
+    """
+    Builds the AST of the codes of dsg and values in one pass over the sorted codes. Each code reuses the nodes
+    of the prefix it shares with the previous code and only walks the rest of its path, children are looked up
+    by index or name. Every code names the nodes of its path, when two codes give different names to the same
+    node it keeps the name of the code which comes last in codes()
+    """
+
     def __init__(self, dsg, values):
         self.dsg = dsg
         self.values = values
-        self.tree = ASTNode('root')
-        self.decode()
+        self.tree = self.decode()
 
-    def decode(self):
+    def codes(self):
+        codes = []
         for column in self.dsg.columns:
-            for code in column.codes:
-                self.decode_node(column.full_name, code)
-
+            # most columns of a schema are not used by the sql
+            if column.path_code:
+                for path_code, branch_code in column.codes:
+                    codes.append((tuple(zip(path_code, branch_code)), column.full_name))
         for table in self.dsg.tables:
-            for code in table.codes:
-                self.decode_node(table.name, code)
-
+            if table.path_code:
+                for path_code, branch_code in table.codes:
+                    codes.append((tuple(zip(path_code, branch_code)), table.name))
         for value in self.values:
-            self.decode_node(value.value, value.codes)
-
-    def decode_node(self, name, code):
-        path_code, branch_code = code
-        if len(path_code) == 0:
-            return
-        cur = self.tree
-        for i, (node, branch) in enumerate(zip(path_code, branch_code)):
-            cur.set_name(node)
-            if node == 'unit':
-                cur.add_named_field(path_code[i + 1])
-                cur = cur[path_code[i + 1]]
-            else:
-                cur.add_field(int(branch))
-                cur = cur[int(branch)]
-        cur.set_name(name)
+            codes.append((tuple(zip(value.path_code, value.branch_code)), value.value))
+        return codes
+
+    def decode(self, ordered=False):
+        """
+        :param ordered: name every node after the last code in codes() which reaches it, a first pass switches to
+        it on the first conflicting name
+        """
+        codes = [code for code in self.codes() if code[0]]
+        order = sorted(range(len(codes)), key=[pairs for pairs, _ in codes].__getitem__)
+        named = {}  # id of a node -> position in codes of the code which named it, when ordered
+        root = ASTNode()
+        stack, last = [root], ()
+        for k in order:
+            pairs, name = codes[k]
+            n = len(pairs)
+            shared, m = 0, min(n, len(last))
+            while shared < m and pairs[shared] == last[shared]:
+                shared += 1
+            if shared and pairs[shared - 1][0] == 'unit':
+                # the child of a unit node is chosen by the next node name
+                shared -= 1
+            del stack[shared + 1:]
+            node = stack[shared]
+            for i in range(shared, n):
+                node_name, branch = pairs[i]
+                if node.name is None:
+                    node.name = node_name
+                elif node.name != node_name and not ordered:
+                    return self.decode(ordered=True)
+                node.isterminal = False
+                if node_name == 'unit':
+                    field = pairs[i + 1][0]
+                    child = node.named_fields.get(field)
+                    if child is None:
+                        child = node.named_fields[field] = ASTNode(field)
+                else:
+                    branch = int(branch)
+                    fields = node.fields.values
+                    while len(fields) <= branch:
+                        fields.append(ASTNode())
+                    child = fields[branch]
+                stack.append(child)
+                node = child
+            if node.name is None:
+                node.name = name
+            elif (node.name != name or type(node.name) is not type(name)) and not ordered:
+                return self.decode(ordered=True)
+            if ordered:
+                for node, node_name in zip(stack, [node_name for node_name, _ in pairs] + [name]):
+                    if named.get(id(node), -1) < k:
+                        node.name = node_name
+                        named[id(node)] = k
+            last = pairs
+        if root.name is None:
+            root.name = 'root'
+        return root
 
 
 class Unparser:
@@ -221,10 +270,146 @@ class Unparser:
             return f"{agg}({col})"
 
 
+
+class Emitter:
+    """
+    Build the spider sql dict straight from the decoded tree, it gives the same result as
+    get_sql(Schema(db), Unparser(tree).get_face_code()) without the unparse/tokenize/reparse round trip
+    """
+    AGG_OPS = ('none', 'max', 'min', 'count', 'sum', 'avg')
+    UNIT_OPS = ['Unary', 'Minus', 'Plus', 'Times', 'Divide']
+    WHERE_OPS = ('not', 'between', '=', '>', '<', '>=', '<=', '!=', 'in', 'like', 'is', 'exists')
+    SQL_OPS = ['union', 'intersect', 'except']
+
+    def __init__(self, tree, db):
+        """
+        :param db: database dict of the transformed database, i.e. Database.to_dict()
+        """
+        self.tree = tree
+        self.idMap = {'*': 0}
+        for tid, tab in enumerate(db["table_names_original"]):
+            self.idMap[tab.lower()] = tid
+        for cid, (tid, col) in enumerate(db["column_names_original"]):
+            if tid >= 0:
+                self.idMap[db["table_names_original"][tid].lower() + '.' + col.lower()] = cid
+
+    def get_sql(self):
+        return self.emit_sql(self.tree)
+
+    def flatten(self, node):
+        # set operations are read from left to right in the face code
+        if node.name in self.SQL_OPS:
+            return self.flatten(node[0]) + [node.name] + self.flatten(node[1])
+        return [node]
+
+    def emit_sql(self, node):
+        units = self.flatten(node)
+        sql = self.emit_sql_unit(units[-1])
+        for i in range(len(units) - 3, -1, -2):
+            nested = sql
+            sql = self.emit_sql_unit(units[i])
+            sql[units[i + 1]] = nested
+        return sql
+
+    def emit_sql_unit(self, node: ASTNode):
+        sql = {'from': self.emit_from(node)}
+        sql['select'] = self.emit_select(node["select"])
+        sql['where'] = self.emit_conds(node["where"][0]) if node.exist("where") else []
+        sql['groupBy'] = [self.emit_col(item) for item in node["groupby"].fields] if node.exist("groupby") else []
+        sql['having'] = self.emit_conds(node["having"][0]) if node.exist("having") else []
+        if node.exist("orderby"):
+            sql['orderBy'], sql['limit'] = self.emit_orderby(node["orderby"][0])
+        else:
+            sql['orderBy'], sql['limit'] = [], None
+        sql['intersect'] = sql['union'] = sql['except'] = None
+        return sql
+
+    def emit_from(self, node: ASTNode):
+        table_units = []
+        for ast in node["from"].fields:
+            if ast.isterminal:
+                table_units.append(('table_unit', self.idMap[ast.name.lower()]))
+            else:
+                table_units.append(('sql', self.emit_sql(ast)))
+        conds = []
+        if node.exist("on"):
+            for item in node["on"].fields:
+                if len(conds) > 0:
+                    conds.append('and')
+                conds.append(self.emit_cond(item))
+        return {'table_units': table_units, 'conds': conds}
+
+    def emit_select(self, node: ASTNode):
+        val_units = []
+        for item in node.fields:
+            if item.name in ["Count", "Avg", "Sum", "Min", "Max"]:
+                val_units.append((self.AGG_OPS.index(item.name.lower()), self.emit_value(item[0])))
+            elif item.name == "Unary" and not item[0].isterminal:
+                # count(col) is read as an aggregation of the select item
+                val_units.append((self.AGG_OPS.index(item[0].name.lower()), (0, self.emit_col(item[0][0]), None)))
+            else:
+                val_units.append((0, self.emit_value(item)))
+        return (False, val_units)
+
+    def emit_orderby(self, node: ASTNode):
+        order = 'asc' if node.name.startswith("asc") else 'desc'
+        limit = node.name[len(order):]
+        return (order, [self.emit_value(item) for item in node.fields]), int(limit) if limit else None
+
+    def emit_conds(self, node: ASTNode):
+        if node.name in ['and', 'or']:
+            left, right = node.fields
+            return self.emit_conds(left) + [node.name] + self.emit_conds(right)
+        else:
+            return [self.emit_cond(node)]
+
+    def emit_cond(self, node: ASTNode):
+        not_op = node.name in ["NotIn", "NotLike"]
+        op = {"NotIn": "in", "NotLike": "like"}.get(node.name, node.name)
+        op_id = self.WHERE_OPS.index(op)
+        if len(node.fields) == 3:
+            left, val1, val2 = node.fields.values
+            return (not_op, op_id, self.emit_value(left), self.emit_operand(val1), self.emit_literal(val2.name))
+        else:
+            left, right = node.fields.values
+            return (not_op, op_id, self.emit_value(left), self.emit_operand(right), None)
+
+    def emit_operand(self, node: ASTNode):
+        if node.name in ['unit', 'union', 'intersect', 'except']:
+            return self.emit_sql(node)
+        elif node.name in self.UNIT_OPS:
+            # a column operand is read as a single col_unit
+            return self.emit_col(node[0])
+        else:
+            return self.emit_literal(node.name)
+
+    def emit_literal(self, value):
+        value = str(value).replace("\'", "\"")
+        if "\"" in value:
+            return value
+        return float(value)
+
+    def emit_value(self, node: ASTNode):
+        if node.name == "Unary":
+            return (0, self.emit_col(node[0]), None)
+        elif node.name in self.UNIT_OPS:
+            col1, col2 = node.fields
+            return (self.UNIT_OPS.index(node.name), self.emit_col(col1), self.emit_col(col2))
+        else:
+            kind = 'terminal' if node.isterminal else '{} fields, named {}'.format(
+                len(node.fields), sorted(map(str, node.named_fields)))
+            raise ValueError('cannot emit a value unit from node {!r} ({})'.format(node.name, kind))
+
+    def emit_col(self, node: ASTNode):
+        if node.isterminal:
+            return (0, self.idMap[node.name.lower()], False)
+        else:
+            return (self.AGG_OPS.index(node.name.lower()), self.idMap[node[0].name.lower()], False)
+
+
 if __name__ == '__main__':
     trains = json.load(open('data/train.json', 'r'))
-    dbs = json.load(open('data/tables_with_annots.json', 'r'))
-    dbs = {db["db_id"]: Database(db) for db in dbs}
+    dbs = DatabaseRegistry.from_path('data/tables_with_annots.json')
     count = 0
     golden, preds = [], []
     kmaps = build_foreign_key_map_from_json('data/tables.json')
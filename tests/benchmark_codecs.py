@@ -0,0 +1,98 @@
+"""
+Benchmarks of the sql codecs against their former implementations in reference_codecs.py, e.g.
+python tests/benchmark_codecs.py --data data/train.json --tables data/tables_with_annots.json
+"""
+import os, sys, json
+import gc
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.dirname(__file__))
+
+from database_utils import DatabaseRegistry
+from sql_parser import SQLEncoder
+from sql_unparser import SQLDecoder
+from reference_codecs import RecursiveSQLEncoder, ReplaySQLDecoder, encoded_codes, ast_signature
+
+
+def time_encoder(encoder_type, dataset, dbs):
+    """
+    Seconds spent encoding dataset (the garbage collector is paused) and the codes of every example. Each
+    example encodes its own copy of the db, which is made outside of the timing and dropped after encoding
+    """
+    seconds = 0.0
+    codes = []
+    for data in dataset:
+        db = dbs[data["db_id"]].copy()
+        gc.disable()
+        start = time.perf_counter()
+        dsg, values = encoder_type(db).encode(data["sql"])
+        seconds += time.perf_counter() - start
+        gc.enable()
+        codes.append(encoded_codes(dsg, values))
+    return seconds, codes
+
+
+def benchmark_encoders(dataset, dbs, repeat=3):
+    """
+    Time SQLEncoder against RecursiveSQLEncoder over dataset (best of repeat runs) and check that both produce
+    the same codes
+    """
+    timings = {}
+    results = {}
+    for _ in range(repeat):
+        for encoder_type in (RecursiveSQLEncoder, SQLEncoder):
+            seconds, codes = time_encoder(encoder_type, dataset, dbs)
+            name = encoder_type.__name__
+            timings[name] = min(timings.get(name, seconds), seconds)
+            results[name] = codes
+    mismatches = sum(a != b for a, b in zip(results['RecursiveSQLEncoder'], results['SQLEncoder']))
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.3f}s, {len(dataset) / seconds:.0f} sql/s")
+    print(f"speedup {timings['RecursiveSQLEncoder'] / timings['SQLEncoder']:.2f}x, {mismatches} mismatches")
+    return timings, mismatches
+
+
+def benchmark_decoders(dataset, dbs, repeat=3):
+    """
+    Time SQLDecoder against ReplaySQLDecoder on the encoded sqls of dataset (best of repeat runs, the garbage
+    collector is paused while timing) and check that both build the same trees. Each sql is encoded outside of
+    the timing and decoded repeat times by both decoders before the next one is encoded
+    """
+    decoder_types = (ReplaySQLDecoder, SQLDecoder)
+    runs = {decoder_type.__name__: [0.0] * repeat for decoder_type in decoder_types}
+    mismatches = 0
+    for data in dataset:
+        dsg, values = SQLEncoder(dbs[data["db_id"]].copy()).encode(data["sql"])
+        trees = {}
+        for run in range(repeat):
+            for decoder_type in decoder_types:
+                gc.disable()
+                start = time.perf_counter()
+                tree = decoder_type(dsg, values).tree
+                seconds = time.perf_counter() - start
+                gc.enable()
+                runs[decoder_type.__name__][run] += seconds
+                trees[decoder_type.__name__] = tree
+        mismatches += ast_signature(trees['ReplaySQLDecoder']) != ast_signature(trees['SQLDecoder'])
+    timings = {name: min(seconds) for name, seconds in runs.items()}
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.3f}s, {len(dataset) / seconds:.0f} sql/s")
+    print(f"speedup {timings['ReplaySQLDecoder'] / timings['SQLDecoder']:.2f}x, {mismatches} mismatches")
+    return timings, mismatches
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--codec', choices=['encoder', 'decoder', 'both'], default='both')
+    arg_parser.add_argument('--data', type=str, default='data/train.json')
+    arg_parser.add_argument('--tables', type=str, default='data/tables_with_annots.json')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+    dataset = json.load(open(args.data, 'r'))
+    dbs = DatabaseRegistry.from_path(args.tables)
+    if args.codec in ('encoder', 'both'):
+        benchmark_encoders(dataset, dbs, args.repeat)
+    if args.codec in ('decoder', 'both'):
+        benchmark_decoders(dataset, dbs, args.repeat)
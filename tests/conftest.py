@@ -0,0 +1,56 @@
+import os, sys, json
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+
+sys.path.append(ROOT)
+
+from jsonl_utils import iter_jsonl
+
+
+@pytest.fixture(scope='session')
+def tables():
+    # synthetic schemas in the format of tables_with_tags.json for six databases of the spider dev set
+    return {db['db_id']: db for db in json.load(open(os.path.join(FIXTURES, 'tables.json'), 'r'))}
+
+
+@pytest.fixture(scope='session')
+def dataset():
+    # the dev examples of those databases
+    return list(iter_jsonl(os.path.join(FIXTURES, 'dev.jsonl')))
+
+
+@pytest.fixture(scope='session')
+def db_dir(tables, tmp_path_factory):
+    """
+    <db_dir>/<db_id>/<db_id>.sqlite for every fixture schema, with a few rows made of its cell values
+    """
+    import sqlite3
+    root = tmp_path_factory.mktemp('database')
+    for db_id, db in tables.items():
+        os.makedirs(root / db_id)
+        conn = sqlite3.connect(str(root / db_id / (db_id + '.sqlite')))
+        for tid, table in enumerate(db['table_names_original']):
+            columns = [(cid, name) for cid, (t, name) in enumerate(db['column_names_original']) if t == tid]
+            types = ['NUMERIC' if db['column_types'][cid] == 'number' else 'TEXT' for cid, _ in columns]
+            conn.execute('CREATE TABLE "{}" ({})'.format(
+                table, ', '.join('"{}" {}'.format(name, dtype) for (_, name), dtype in zip(columns, types))))
+            for row in range(4):
+                values = []
+                for cid, _ in columns:
+                    cells = db['cell_values'][cid]
+                    values.append(' '.join(cells[row % len(cells)]) if cells else row)
+                conn.execute('INSERT INTO "{}" VALUES ({})'.format(table, ', '.join('?' * len(values))), values)
+        conn.commit()
+        conn.close()
+    return str(root)
+
+
+@pytest.fixture(scope='session')
+def queries(tables, dataset):
+    # (query, db_id) of every example, unparsed from its sql so that it refers to the fixture schemas
+    from codec_utils import SQLCodec
+    codec = SQLCodec(tables)
+    return [(codec.roundtrip(data['db_id'], data['sql']), data['db_id']) for data in dataset]
@@ -0,0 +1,46 @@
+import os
+import random
+
+from aug_system import Generator
+import cell_utils
+from cell_utils import CellValueStore, CellRef, column_cell_values
+from database_utils import Database
+
+
+def test_compacted_tables_resolve_lazily_from_the_store_root(tables, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = CellValueStore.build(tables, 'cells')
+    compact = {db_id: store.compact(db, db_id) for db_id, db in tables.items()}
+    # the output only refers to the store relative to the store root, e.g. the repository on another machine
+    moved = tmp_path / 'moved'
+    moved.mkdir()
+    (tmp_path / 'cells').rename(moved / 'cells')
+    monkeypatch.chdir('/')
+    monkeypatch.setattr(cell_utils, '_store_root', None)
+    cell_utils.set_store_root(moved)
+
+    for db_id, db in compact.items():
+        assert db['cell_source']['store'] == 'cells'
+        database = Database(db)
+        refs = [column for column in database.columns if type(column._cell_values) is CellRef]
+        assert refs or not any(tables[db_id]['cell_values'])
+        for cid, column in enumerate(database.columns):
+            assert column.cell_values == tables[db_id]['cell_values'][cid]
+            assert column_cell_values(db, cid) == tables[db_id]['cell_values'][cid]
+        assert not any(type(column._cell_values) is CellRef for column in database.columns)
+
+
+def test_compacted_tables_refer_to_the_store_from_its_root(tables, tmp_path):
+    store = CellValueStore.build(tables, str(tmp_path / 'gendata' / 'cells'), root=str(tmp_path))
+    db_id = next(iter(tables))
+    assert store.compact(tables[db_id], db_id)['cell_source']['store'] == os.path.join('gendata', 'cells')
+
+
+def test_generated_tables_resolve_to_plain_output(tables, dataset, tmp_path):
+    outputs = []
+    for store in (None, CellValueStore.build(tables, str(tmp_path / 'cells'))):
+        random.seed(42)
+        generator = Generator(cell_store=store)
+        aug_dataset, aug_databases = generator.generate_all(tables, dataset)
+        outputs.append([(db['db_id'], Database(db).to_dict()['cell_values']) for db in aug_databases])
+    assert outputs[0] == outputs[1]
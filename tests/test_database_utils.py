@@ -0,0 +1,195 @@
+import copy, json
+import random
+
+from aug_system import Generator
+from database_utils import Column, Table, Database, ColumnIndex, TableIndex, NameIndex, DatabaseRegistry, \
+    database_hash, with_agents
+from erg_utils import Entity, StateSnapshot
+from jsonl_utils import JsonlTables
+from sql_parser import SQLEncoder
+from reference_codecs import encoded_codes
+
+
+def make_column(name, table):
+    column = Column(name, 0)
+    column.table = table
+    return column
+
+
+def test_column_index_matches_list_scan():
+    tables = [Table(f't{i}', i) for i in range(3)]
+    columns = [make_column(f'c{i}', table) for table in tables for i in range(4)]
+    index = ColumnIndex(columns)
+    probes = [make_column(f'c{i}', Table(f't{j}', 0)) for i in range(5) for j in range(4)]
+    for probe in probes + columns:
+        assert (probe in index) == (probe in columns)
+
+    # a moved column is found under its new table once refreshed
+    moved = columns[0]
+    moved.table = tables[2]
+    index.refresh(moved)
+    for probe in probes + columns:
+        assert (probe in index) == (probe in columns)
+
+
+def test_table_index_matches_list_scan():
+    tables = [Table(f't{i}', i) for i in range(3)]
+    index = TableIndex(tables)
+    for probe in [Table(f't{i}', 0) for i in range(5)]:
+        assert (probe in index) == (probe in tables)
+
+
+def test_database_add_dedups_renamed_members():
+    db = Database()
+    tables = [Table(f't{i}', i) for i in range(40)]
+    for table in tables:
+        db.add_table(table)
+        for i in range(2):
+            db.add_column(make_column(f'c{i}', table))
+    db.add_table(Table('t1', 0))
+    assert len(db.tables) == 40
+
+    tables[1].name = 'renamed'
+    db.add_table(Table('t1', 0))
+    assert len(db.tables) == 41
+    db.add_table(Table('renamed', 0))
+    assert len(db.tables) == 41
+
+    db.columns[0].name = 'moved'
+    db.add_column(make_column('c0', tables[0]))
+    assert len(db.columns) == 81
+    db.add_column(make_column('moved', tables[0]))
+    assert len(db.columns) == 81
+
+
+def test_table_add_dedups_renamed_members():
+    table = Table('t', 0)
+    for i in range(NameIndex.MIN_SIZE + 8):
+        table.add_column(make_column(f'c{i}', table))
+    assert table._column_index is not None
+    size = len(table.columns)
+    table.add_column(make_column('c3', table))
+    assert len(table.columns) == size
+
+    table.columns[3].name = 'moved'
+    table.add_column(make_column('moved', table))
+    assert len(table.columns) == size
+    table.add_column(make_column('c3', table))
+    assert len(table.columns) == size + 1
+
+    # columns are compared by the name of their table, which can be renamed under the index
+    table.name = 'renamed'
+    table.add_column(make_column('c4', Table('t', 0)))
+    assert len(table.columns) == size + 2
+    table.add_column(make_column('c4', Table('renamed', 0)))
+    assert len(table.columns) == size + 2
+
+
+def test_entity_index_survives_rollback():
+    table = Table('t', 0)
+    entity = Entity(table)
+    for i in range(NameIndex.MIN_SIZE):
+        entity.add_attribute(make_column(f'c{i}', table))
+    snapshot = StateSnapshot(entity)
+    entity.attributes[0].name = 'moved'
+    entity.add_attribute(make_column('c0', table))
+    snapshot.restore()
+    entity.add_attribute(make_column('c0', table))
+    entity.add_attribute(make_column('moved', table))
+    assert [column.name for column in entity.attributes] == [f'c{i}' for i in range(NameIndex.MIN_SIZE)] + ['moved']
+
+
+def widen(db, n_tables, n_columns):
+    """
+    Copy of a table dict with n_tables more tables of n_columns columns each
+    """
+    db = copy.deepcopy(db)
+    for t in range(n_tables):
+        tid = len(db['table_names_original'])
+        db['table_names_original'].append(f'extra_{t}')
+        db['table_names'].append(f'extra {t}')
+        db['table_type'].append(db['table_type'][0])
+        db['tag'].append(db['tag'][0])
+        db['primary_keys'].append(len(db['column_names']))
+        for c in range(n_columns):
+            db['column_names_original'].append([tid, f'extra_{t}_{c}'])
+            db['column_names'].append([tid, f'extra {t} {c}'])
+            db['column_types'].append('text')
+            db['cell_values'].append([])
+    return db
+
+
+def test_generate_all_on_a_large_schema(tables, dataset):
+    # far wider than baseball_1, which generation used to skip
+    db_id = 'concert_singer'
+    data = [data for data in dataset if data['db_id'] == db_id]
+    queries = []
+    for db in (tables[db_id], widen(tables[db_id], 2, 300)):
+        random.seed(42)
+        aug_dataset, _ = Generator().generate_all({db_id: db}, data)
+        queries.append([data['query'] for data in aug_dataset])
+    assert queries[0] and queries[0] == queries[1]
+
+
+def fk_names(db):
+    return sorted((column.full_name, column.fk.full_name) for column in db.columns if column.fk is not None)
+
+
+def test_snapshot_copies_only_written_tables(tables, dataset):
+    dbs = DatabaseRegistry(tables)
+    for data in dataset:
+        db = dbs[data['db_id']]
+        before = db.to_dict()
+        snapshot, values = SQLEncoder(db.snapshot()).encode(data['sql'])
+        assert db.to_dict() == before
+        assert not any(item.path_code for item in db.tables + db.columns)
+        for table, source in zip(snapshot.tables, db.tables):
+            written = table.path_code or any(column.path_code for column in table.columns)
+            assert (table is source) == (not written)
+
+        expected = SQLEncoder(db.copy()).encode(data['sql'])
+        assert encoded_codes(snapshot, values) == encoded_codes(*expected)
+        private = snapshot.copy()
+        assert private.to_dict() == expected[0].to_dict() and fk_names(private) == fk_names(expected[0])
+        assert not set(map(id, private.tables + private.columns)) & set(map(id, db.tables + db.columns))
+
+
+def agent_names(db):
+    return [[column.name for column in table.agents] for table in db.tables]
+
+
+def test_stored_agents_match_detection(tables, dataset):
+    # generated schemas carry the agents Database would detect on them, as do sources through with_agents
+    random.seed(42)
+    _, aug_databases = Generator(n_step=2).generate(tables, dataset)
+    assert aug_databases and all('agents' in db for db in aug_databases)
+    for db in list(tables.values()) + aug_databases:
+        plain = {k: v for k, v in db.items() if k != 'agents'}
+        stored = with_agents(plain)
+        assert stored['agents'] == db.get('agents', stored['agents'])
+        assert agent_names(Database(stored)) == agent_names(Database(plain))
+        assert database_hash(stored) == database_hash(plain)
+
+
+def test_registry_reuses_until_table_replaced(tables):
+    tables = dict(tables)
+    registry = DatabaseRegistry(tables, maxsize=2)
+    db = registry['pets_1']
+    assert registry['pets_1'] is db and registry.hits == 1
+    tables['pets_1'] = copy.deepcopy(tables['pets_1'])
+    assert registry['pets_1'] is not db
+    for db_id in ['concert_singer', 'course_teach', 'pets_1']:
+        registry[db_id]
+    assert len(registry.cache) == 2 and 'concert_singer' not in registry.cache
+
+
+def test_registry_hits_do_not_read_jsonl(tables, tmp_path):
+    path = tmp_path / 'tables.jsonl'
+    path.write_text(''.join(json.dumps(db) + '\n' for db in tables.values()))
+    jsonl = JsonlTables(str(path))
+    registry = DatabaseRegistry(jsonl)
+    db = registry['voter_1']
+    reads = []
+    read = jsonl.dataset._read
+    jsonl.dataset._read = lambda *args: reads.append(args) or read(*args)
+    assert registry['voter_1'] is db and not reads
@@ -0,0 +1,33 @@
+import json
+import random
+
+import pytest
+
+from aug_system import Generator
+from sql_unparser import ASTNode, Emitter
+
+
+@pytest.mark.parametrize('affected', [True, False])
+def test_emitted_sql_matches_reparse(tables, dataset, affected):
+    random.seed(42)
+    generator = Generator(affected=affected, sql_mode="verify")
+    aug_dataset, _ = generator.generate_all(tables, dataset)
+    assert generator.sql_failures == []
+    assert generator.sql_check == {"match": len(aug_dataset), "mismatch": 0, "error": 0}
+    assert len(aug_dataset) > 0
+
+
+def test_emit_mode_output(tables, dataset):
+    outputs = []
+    for sql_mode in ("reparse", "emit"):
+        random.seed(42)
+        generator = Generator(n_step=2, sql_mode=sql_mode)
+        outputs.append(json.dumps(generator.generate(tables, dataset)))
+    assert outputs[0] == outputs[1]
+
+
+def test_emit_value_error_names_the_node():
+    node = ASTNode('Count')
+    node.add_field(0)
+    with pytest.raises(ValueError, match="'Count' \\(1 fields"):
+        Emitter.__new__(Emitter).emit_value(node)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from conftest import FIXTURES
+from eval.spider import evaluation
+from eval.spider.evaluation import build_foreign_key_map_from_json, evaluate, eval_exec_match, ExecEngine, \
+    ConnectionPool, GoldResultCache
+
+
+@pytest.fixture
+def table(tmp_path):
+    path = str(tmp_path / 'tables.json')
+    shutil.copy(os.path.join(FIXTURES, 'tables.json'), path)
+    return path
+
+
+def test_kmaps_cache_is_opt_in(table, tmp_path):
+    kmaps = build_foreign_key_map_from_json(table)
+    assert os.listdir(tmp_path) == ['tables.json']
+    assert build_foreign_key_map_from_json(table, use_cache=True) == kmaps
+    assert sorted(os.listdir(tmp_path)) == ['tables.json', 'tables.json.kmaps.json']
+    assert build_foreign_key_map_from_json(table, use_cache=True) == kmaps
+
+
+def test_kmaps_cache_failed_write_leaves_no_tmp(table, tmp_path, monkeypatch):
+    def replace(src, dst):
+        raise OSError('read-only')
+
+    monkeypatch.setattr(evaluation.os, 'replace', replace)
+    kmaps = build_foreign_key_map_from_json(table, use_cache=True)
+    assert kmaps and os.listdir(tmp_path) == ['tables.json']
+
+
+def executable(queries, db_dir):
+    result = []
+    for query, db_id in queries:
+        conn = sqlite3.connect(os.path.join(db_dir, db_id, db_id + '.sqlite'))
+        try:
+            conn.execute(query).fetchall()
+            result.append((query, db_id))
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+    return result
+
+
+@pytest.fixture
+def exec_files(queries, db_dir, tmp_path):
+    """
+    Gold and predicted query files, every other prediction is the gold query of the previous example of the db
+    and one deletes all the rows its gold query reads
+    """
+    gold = executable(queries, db_dir)
+    preds = [query if i % 2 == 0 or gold[i - 1][1] != db_id else gold[i - 1][0]
+             for i, (query, db_id) in enumerate(gold)]
+    preds[0] = 'DELETE FROM singer'
+    gold_path, pred_path = str(tmp_path / 'gold.sql'), str(tmp_path / 'pred.sql')
+    with open(gold_path, 'w') as f:
+        f.writelines('{}\t{}\n'.format(query, db_id) for query, db_id in gold)
+    with open(pred_path, 'w') as f:
+        f.writelines(pred + '\n' for pred in preds)
+    return gold_path, pred_path
+
+
+def test_exec_engine_scores_match_serial(exec_files, db_dir):
+    kmaps = build_foreign_key_map_from_json(os.path.join(FIXTURES, 'tables.json'))
+    serial = evaluate(*exec_files, db_dir, 'exec', kmaps)[0]
+    parallel = evaluate(*exec_files, db_dir, 'exec', kmaps, exec_workers=2)[0]
+    assert 0 < serial < 1
+    assert parallel == serial
+    for mode in ConnectionPool.MODES:
+        assert evaluate(*exec_files, db_dir, 'exec', kmaps, connections=ConnectionPool(mode))[0] == serial
+        assert evaluate(*exec_files, db_dir, 'exec', kmaps, exec_workers=2,
+                        connections=ConnectionPool(mode))[0] == serial
+
+
+@pytest.mark.parametrize('mode', ConnectionPool.MODES)
+def test_writing_prediction_runs_on_the_file(db_dir, mode):
+    db = os.path.join(db_dir, 'concert_singer', 'concert_singer.sqlite')
+    job = (db, 'DELETE FROM singer', 'SELECT count(*) FROM singer', [], [])
+    sql = {'select': [False, []]}
+    serial = eval_exec_match(db, job[1], job[2], sql, sql)
+    assert serial
+    assert eval_exec_match(db, job[1], job[2], sql, sql, connections=ConnectionPool(mode)) == serial
+    assert ExecEngine(1, snapshot=mode).run([job]) == [serial]
+    conn = sqlite3.connect(db)
+    assert conn.execute('SELECT count(*) FROM singer').fetchone()[0] == 4
+    conn.close()
+
+
+def test_exec_engine_limits_only_predictions(db_dir):
+    db = os.path.join(db_dir, 'pets_1', 'pets_1.sqlite')
+    slow = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 200000) SELECT count(*) FROM c'
+    engine = ExecEngine(1, timeout=0.0, max_rows=1)
+    jobs = [(db, 'SELECT 200000', slow, [], []), (db, slow, 'SELECT 200000', [], []),
+            (db, 'SELECT 1 UNION SELECT 2', 'SELECT 1 UNION SELECT 2', [], [])]
+    assert engine.run(jobs) == [True, False, False]
+
+
+def test_evaluate_passes_exec_limits(exec_files, db_dir):
+    kmaps = build_foreign_key_map_from_json(os.path.join(FIXTURES, 'tables.json'))
+    serial = evaluate(*exec_files, db_dir, 'exec', kmaps)[0]
+    assert evaluate(*exec_files, db_dir, 'exec', kmaps, exec_workers=2, exec_timeout=60.0,
+                    exec_max_rows=10 ** 6)[0] == serial
+    # every prediction which returns a row now fails
+    assert evaluate(*exec_files, db_dir, 'exec', kmaps, exec_workers=2, exec_max_rows=0)[0] < serial
+
+
+def test_gold_cache_second_run_only_hits(exec_files, db_dir, tmp_path):
+    kmaps = build_foreign_key_map_from_json(os.path.join(FIXTURES, 'tables.json'))
+    uncached = evaluate(*exec_files, db_dir, 'exec', kmaps)
+    path = str(tmp_path / 'gold.sqlite')
+    first = GoldResultCache(path)
+    assert evaluate(*exec_files, db_dir, 'exec', kmaps, gold_cache=first) == uncached
+    assert first.misses > 0
+    first.close()
+    second = GoldResultCache(path)
+    assert evaluate(*exec_files, db_dir, 'exec', kmaps, gold_cache=second) == uncached
+    assert second.misses == 0 and second.hits > 0
+    second.close()
@@ -0,0 +1,46 @@
+import pytest
+
+from eval.spider.process_sql import tokenize, tokenize_reference
+
+
+def punkt_installed():
+    try:
+        tokenize_reference('SELECT 1')
+    except LookupError:
+        return False
+    return True
+
+
+# tokenize falls back to nltk for these, e.g. a trailing period
+requires_punkt = pytest.mark.skipif(not punkt_installed(), reason='nltk punkt data is not installed')
+
+EDGE_CASES = [
+    ('SELECT * FROM t WHERE a = "x, y" AND b = \'don t\'',
+     ['select', '*', 'from', 't', 'where', 'a', '=', '"x, y"', 'and', 'b', '=', '"don t"']),
+    ('SELECT a FROM t WHERE b != 3 AND c >= 4 AND d <= 5 AND e > 6',
+     ['select', 'a', 'from', 't', 'where', 'b', '!=', '3', 'and', 'c', '>=', '4', 'and', 'd', '<=', '5', 'and', 'e',
+      '>', '6']),
+    # without spaces nltk keeps the = with the number, the operators are not merged
+    ('SELECT a FROM t WHERE b!=3 AND c>=4 AND d<=-1',
+     ['select', 'a', 'from', 't', 'where', 'b', '!', '=3', 'and', 'c', '>', '=4', 'and', 'd', '<', '=-1']),
+    pytest.param('SELECT count(*) FROM t WHERE a = 1.',
+                 ['select', 'count', '(', '*', ')', 'from', 't', 'where', 'a', '=', '1', '.'], marks=requires_punkt),
+    pytest.param('SELECT a FROM t WHERE b = 2.5 LIMIT 1.',
+                 ['select', 'a', 'from', 't', 'where', 'b', '=', '2.5', 'limit', '1', '.'], marks=requires_punkt),
+    ('SELECT a ,1,2 FROM t WHERE b IN (1,2,3)',
+     ['select', 'a', ',1,2', 'from', 't', 'where', 'b', 'in', '(', '1,2,3', ')']),
+    ("SELECT avg(age) ,  max(age) FROM t WHERE x LIKE '%a%'",
+     ['select', 'avg', '(', 'age', ')', ',', 'max', '(', 'age', ')', 'from', 't', 'where', 'x', 'like', '"%a%"']),
+]
+
+
+@pytest.mark.parametrize('query, expected', EDGE_CASES)
+def test_tokenize_edge_cases(query, expected):
+    assert tokenize(query) == expected
+
+
+@requires_punkt
+def test_tokenize_matches_reference(dataset):
+    edge_cases = [case.values[0] if hasattr(case, 'values') else case[0] for case in EDGE_CASES]
+    for query in [data['query'] for data in dataset] + edge_cases:
+        assert tokenize(query) == tokenize_reference(query), query
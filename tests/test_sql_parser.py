@@ -0,0 +1,11 @@
+from database_utils import DatabaseRegistry
+from sql_parser import SQLEncoder
+from reference_codecs import RecursiveSQLEncoder, encoded_codes
+
+
+def test_encoder_matches_reference(tables, dataset):
+    dbs = DatabaseRegistry(tables)
+    for data in dataset:
+        db = dbs[data["db_id"]]
+        expected = encoded_codes(*RecursiveSQLEncoder(db.copy()).encode(data["sql"]))
+        assert encoded_codes(*SQLEncoder(db.copy()).encode(data["sql"])) == expected, data["query"]
@@ -0,0 +1,35 @@
+import random
+
+import aug_system
+from aug_system import Generator
+from database_utils import DatabaseRegistry
+from sql_parser import SQLEncoder
+from sql_unparser import SQLDecoder
+from reference_codecs import ReplaySQLDecoder, ast_signature
+
+
+def test_decoder_matches_reference(tables, dataset):
+    dbs = DatabaseRegistry(tables)
+    for data in dataset:
+        dsg, values = SQLEncoder(dbs[data["db_id"]].copy()).encode(data["sql"])
+        expected = ast_signature(ReplaySQLDecoder(dsg, values).tree)
+        assert ast_signature(SQLDecoder(dsg, values).tree) == expected, data["query"]
+
+
+def test_decoder_resolves_conflicts_like_reference(tables, dataset, monkeypatch):
+    # transformed databases can give different names to the same node, e.g. a column and a subquery
+    conflicts, same = [], []
+
+    class CheckedDecoder(SQLDecoder):
+        def decode(self, ordered=False):
+            tree = super().decode(ordered)
+            if ordered:
+                conflicts.append(self.dsg.db_id)
+            else:
+                same.append(ast_signature(tree) == ast_signature(ReplaySQLDecoder(self.dsg, self.values).tree))
+            return tree
+
+    monkeypatch.setattr(aug_system, 'SQLDecoder', CheckedDecoder)
+    random.seed(42)
+    Generator(n_step=2).generate(tables, dataset)
+    assert conflicts and same and all(same)